@@ -0,0 +1,112 @@
+"""
+RAG vector storage benchmark.
+Reports recall@k and memory for float32 / float16 / int8 first-pass vectors
+(with and without full-precision rerank) on a real patient board index, and
+recall@k vs latency of the IVF approximate backend across nprobe values
+against the exact scan.
+
+Usage:
+    python benchmark_rag.py [--patient p0001] [--k 5] [--samples 200] [--query "ALT trend" ...]
+                            [--nlist 64] [--nprobe 1 --nprobe 4 ...]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import rag
+
+
+def exact_top(matrix: np.ndarray, query_vec: np.ndarray, k: int) -> set:
+    return {row for _, row in rag._top_rows(matrix, query_vec, k)}
+
+
+def load_queries(index: rag.RagIndex, samples: int, texts: list, seed: int = 7) -> np.ndarray:
+    """Real query embeddings (if given) plus board rows perturbed with a little noise."""
+    rng = np.random.default_rng(seed)
+    matrix = np.asarray(index.matrix, dtype=np.float32)
+    rows = rng.choice(len(matrix), size=min(samples, len(matrix)), replace=False)
+    queries = [rag.normalize_vector(matrix[r] + rng.normal(0, 0.02, matrix.shape[1])) for r in rows]
+    for text in texts:
+        vector = rag.get_embeddings(text)
+        if vector:
+            queries.append(rag.normalize_vector(vector))
+    return np.array(queries, dtype=np.float32)
+
+
+def benchmark(index: rag.RagIndex, queries: np.ndarray, k: int, rerank_factor: int) -> None:
+    matrix = np.asarray(index.matrix, dtype=np.float32)
+    truth = [exact_top(matrix, q, k) for q in queries]
+
+    print(f"\nRows: {len(matrix)}  dim: {matrix.shape[1]}  queries: {len(queries)}  k: {k}  rerank x{rerank_factor}")
+    print(f"{'dtype':<8} {'memory':>10} {'recall@k':>9} {'+rerank':>8} {'ms/query':>9}")
+    for dtype in ("float32", "float16", "int8"):
+        if dtype == "float32":
+            qmatrix, scales = matrix, None
+        else:
+            qmatrix, scales = rag.quantize(matrix, dtype)
+        memory = qmatrix.nbytes + (scales.nbytes if scales is not None else 0)
+
+        plain_hits = rerank_hits = 0
+        start = time.perf_counter()
+        for q, expected in zip(queries, truth):
+            first = rag._top_rows(qmatrix, q, k * rerank_factor, scales)
+            plain_hits += len({row for _, row in first[:k]} & expected)
+            rows = sorted(row for _, row in first)
+            exact = matrix[rows] @ q
+            reranked = {row for _, row in sorted(zip(exact.tolist(), rows), reverse=True)[:k]}
+            rerank_hits += len(reranked & expected)
+        elapsed = (time.perf_counter() - start) * 1000 / len(queries)
+
+        total = k * len(queries)
+        print(f"{dtype:<8} {memory / 1024:>8.1f}KB {plain_hits / total:>9.3f} {rerank_hits / total:>8.3f} {elapsed:>9.3f}")
+
+
+def benchmark_ivf(index: rag.RagIndex, queries: np.ndarray, k: int, nlist: int, nprobes: list) -> None:
+    matrix = np.asarray(index.matrix, dtype=np.float32)
+    start = time.perf_counter()
+    truth = [exact_top(matrix, q, k) for q in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    start = time.perf_counter()
+    centroids = rag.train_ivf(matrix, nlist)
+    ivf = rag.IVFIndex(centroids, rag.assign_ivf(matrix, centroids), len(matrix))
+    train_s = time.perf_counter() - start
+
+    print(f"\nIVF: {len(centroids)} lists (trained in {train_s:.2f}s)  exact scan: {exact_ms:.3f} ms/query")
+    print(f"{'nprobe':<8} {'scanned':>8} {'recall@k':>9} {'ms/query':>9}")
+    for nprobe in nprobes:
+        hits = scanned = 0
+        start = time.perf_counter()
+        for q, expected in zip(queries, truth):
+            rows = ivf.candidates(q, nprobe)
+            scanned += len(rows)
+            similarities = matrix[rows] @ q
+            top = np.argsort(similarities)[::-1][:k]
+            hits += len({int(rows[t]) for t in top} & expected)
+        elapsed = (time.perf_counter() - start) * 1000 / len(queries)
+        print(f"{nprobe:<8} {scanned / len(queries) / len(matrix):>7.1%} {hits / (k * len(queries)):>9.3f} {elapsed:>9.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patient", default=None, help="Patient partition to benchmark (default: current patient)")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--samples", type=int, default=200, help="Board rows used as (noisy) queries")
+    parser.add_argument("--query", action="append", default=[], help="Real query text (costs one embedding call each)")
+    parser.add_argument("--rerank-factor", type=int, default=rag.RAG_RERANK_FACTOR)
+    parser.add_argument("--nlist", type=int, default=0, help="IVF lists (default: ~sqrt(rows))")
+    parser.add_argument("--nprobe", type=int, action="append", default=[], help="IVF lists probed (repeatable)")
+    args = parser.parse_args()
+
+    index = rag.rag_index.get(args.patient)
+    if len(index) == 0:
+        index.sync()
+    if index.matrix is None:
+        raise SystemExit("Index is empty - nothing to benchmark.")
+
+    queries = load_queries(index, args.samples, args.query)
+    k = min(args.k, len(index.matrix))
+    benchmark(index, queries, k, args.rerank_factor)
+    benchmark_ivf(index, queries, k, args.nlist or rag.ivf_nlist(len(index.matrix)), args.nprobe or [1, 2, 4, 8, 16])
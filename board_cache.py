@@ -0,0 +1,186 @@
+"""
+Shared board snapshot cache.
+Every module that needs /api/board-items/{patient} goes through one
+BoardCache: snapshots are kept per patient for a short TTL, concurrent
+fetches of the same patient collapse into one request (single-flight, across
+threads and event loops), revalidation uses ETag / Last-Modified, and each
+consumer's filtered view is computed once per snapshot version.
+"""
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from http_client import http_client
+from patient_manager import patient_manager
+
+# Seconds a snapshot is served without revalidating against the canvas
+BOARD_CACHE_TTL = float(os.getenv("BOARD_CACHE_TTL", "5"))
+BOARD_FETCH_TIMEOUT = 10
+
+
+class BoardSnapshot:
+    """One version of a patient's board; a changed board gets a new snapshot rather than new items."""
+
+    def __init__(self, patient_id: str, version: int, items: List[Any], digest: str):
+        self.patient_id = patient_id
+        self.version = version
+        self.items = items
+        self.digest = digest
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.fetched_at = 0.0
+        # Consumer name -> filtered view of this version
+        self.views: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def view(self, name: str, build: Callable[[List[Any]], Any], copy_items: bool = True) -> Any:
+        """
+        Consumer-specific view of this version, built once.
+        'build' gets shallow copies of the items (unless copy_items is False,
+        for builders that never modify them), so it may set keys on them;
+        the returned view is shared and must be treated as read-only.
+        """
+        with self._lock:
+            if name not in self.views:
+                items = [dict(d) if isinstance(d, dict) else d for d in self.items] if copy_items else self.items
+                self.views[name] = build(items)
+            return self.views[name]
+
+
+class BoardCache:
+    """Per-patient board snapshots with TTL, single-flight fetches and conditional requests."""
+
+    def __init__(self, ttl: float = BOARD_CACHE_TTL, timeout: float = BOARD_FETCH_TIMEOUT):
+        self.ttl = ttl
+        self.timeout = timeout
+        self._snapshots: Dict[str, BoardSnapshot] = {}
+        self._fetch_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        # Called with the patient id whenever this process invalidates a board
+        self._invalidate_listeners: List[Callable[[str], None]] = []
+        self.stats_counters = {"hits": 0, "fetches": 0, "not_modified": 0, "changes": 0, "errors": 0}
+
+    def snapshot(self, patient_id: Optional[str] = None, max_age: Optional[float] = None) -> BoardSnapshot:
+        """
+        Current snapshot for a patient (default: the active one), fetched or
+        revalidated if older than max_age (default: the TTL). Callers arriving
+        while a fetch is in flight wait for it instead of fetching again.
+        If the canvas is unreachable, the last snapshot is served stale.
+        """
+        patient_id = (patient_id or patient_manager.get_patient_id()).lower()
+        max_age = self.ttl if max_age is None else max_age
+        requested = time.time()
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(patient_id, threading.Lock())
+        snap = self._snapshots.get(patient_id)
+        if snap is not None and snap.fetched_at >= requested - max_age:
+            self.stats_counters["hits"] += 1
+            return snap
+        with fetch_lock:
+            # Someone else may have fetched while we waited
+            snap = self._snapshots.get(patient_id)
+            if snap is not None and snap.fetched_at >= requested - max_age:
+                self.stats_counters["hits"] += 1
+                return snap
+            try:
+                return self._fetch(patient_id, snap)
+            except Exception as e:
+                self.stats_counters["errors"] += 1
+                if snap is None:
+                    raise
+                print(f"⚠️ Board fetch failed, serving snapshot v{snap.version}: {e}")
+                return snap
+
+    def _fetch(self, patient_id: str, previous: Optional[BoardSnapshot]) -> BoardSnapshot:
+        headers = {}
+        if previous is not None and previous.etag:
+            headers["If-None-Match"] = previous.etag
+        if previous is not None and previous.last_modified:
+            headers["If-Modified-Since"] = previous.last_modified
+        url = patient_manager.get_base_url() + f"/api/board-items/{patient_id}"
+        print(f"🌍 Fetching from: {url}")
+        self.stats_counters["fetches"] += 1
+        response = http_client.get(url, headers=headers, timeout=self.timeout)
+
+        if response.status_code == 304 and previous is not None:
+            self.stats_counters["not_modified"] += 1
+            previous.fetched_at = time.time()
+            return previous
+        response.raise_for_status()
+
+        digest = hashlib.md5(response.content).hexdigest()
+        if previous is not None and digest == previous.digest:
+            # Canvas without validators: same body, same version
+            snap = previous
+        else:
+            data = response.json()
+            # Handle new API format: {"patientId": "...", "items": [...]}
+            if isinstance(data, dict) and "items" in data:
+                data = data["items"]
+            if not isinstance(data, list):
+                raise ValueError("Expected list, got " + str(type(data)))
+            snap = BoardSnapshot(patient_id, (previous.version if previous else 0) + 1, data, digest)
+            self.stats_counters["changes"] += 1
+            print(f"✅ Board v{snap.version} for {patient_id}: {len(data)} items")
+        snap.etag = response.headers.get("ETag") or snap.etag
+        snap.last_modified = response.headers.get("Last-Modified") or snap.last_modified
+        snap.fetched_at = time.time()
+        self._snapshots[patient_id] = snap
+        return snap
+
+    def view(
+        self,
+        name: str,
+        build: Callable[[List[Any]], Any],
+        patient_id: Optional[str] = None,
+        max_age: Optional[float] = None,
+        copy_items: bool = True,
+    ) -> Any:
+        """Consumer-specific view of the current snapshot (see BoardSnapshot.view)."""
+        return self.snapshot(patient_id, max_age).view(name, build, copy_items)
+
+    async def snapshot_async(self, patient_id: Optional[str] = None, max_age: Optional[float] = None) -> BoardSnapshot:
+        return await asyncio.to_thread(self.snapshot, patient_id, max_age)
+
+    async def view_async(
+        self,
+        name: str,
+        build: Callable[[List[Any]], Any],
+        patient_id: Optional[str] = None,
+        max_age: Optional[float] = None,
+        copy_items: bool = True,
+    ) -> Any:
+        return await asyncio.to_thread(self.view, name, build, patient_id, max_age, copy_items)
+
+    def invalidate(self, patient_id: Optional[str] = None) -> None:
+        """
+        Force the next read to revalidate (e.g. after this process edited the
+        board) and tell the listeners, so derived state (the RAG partition,
+        the board watcher) catches up too.
+        """
+        patient_id = (patient_id or patient_manager.get_patient_id()).lower()
+        snap = self._snapshots.get(patient_id)
+        if snap is not None:
+            snap.fetched_at = 0.0
+        for callback in list(self._invalidate_listeners):
+            try:
+                callback(patient_id)
+            except Exception as e:
+                print(f"⚠️ Board invalidation listener failed: {e}")
+
+    def on_invalidate(self, callback: Callable[[str], None]) -> None:
+        """Call callback(patient_id) after every invalidate()."""
+        self._invalidate_listeners.append(callback)
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(self.stats_counters)
+        stats["versions"] = {p: s.version for p, s in self._snapshots.items()}
+        return stats
+
+
+# Process-wide board cache
+board_cache = BoardCache()
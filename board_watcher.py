@@ -0,0 +1,157 @@
+"""
+Background board watcher for the server process.
+Polls /api/board-items/{patient} on an interval through the shared board
+cache (conditional requests with ETag / Last-Modified), takes the item-level
+change set from canvas_ops' change feed and syncs the RAG partition off the
+request path, so queries always hit an already-synced index. Staleness and
+lag are published through stats().
+"""
+
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import canvas_ops
+import rag
+from board_cache import board_cache
+from embedding_store import embedding_store
+from patient_manager import patient_manager
+
+# Seconds between polls; 0 disables the watcher
+WATCH_INTERVAL = float(os.getenv("RAG_WATCH_INTERVAL", "15"))
+
+
+class BoardWatcher:
+    """Keeps the current patient's RAG partition in step with the canvas board."""
+
+    def __init__(self, interval: float = WATCH_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Per patient: last synced board version, and change sets seen since
+        self.versions: Dict[str, int] = {}
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._pending_lock = threading.Lock()
+        canvas_ops.subscribe(self._on_changes)
+        board_cache.on_invalidate(self._on_invalidate)
+        self.metrics: Dict[str, Any] = {
+            "polls": 0,
+            "not_modified": 0,
+            "unchanged": 0,
+            "changes": 0,
+            "errors": 0,
+            "last_error": None,
+            "last_poll": 0.0,
+            "last_ok": 0.0,
+            "last_change_seen": 0.0,
+            "last_sync_lag": 0.0,
+        }
+
+    def start(self) -> None:
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="board-watcher", daemon=True)
+        self._thread.start()
+        print(f"Board watcher started (every {self.interval:.0f}s)")
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=board_cache.timeout + 1)
+            self._thread = None
+
+    def wake(self) -> None:
+        """Poll now instead of waiting for the interval (e.g. after a patient switch)."""
+        self._wake.set()
+
+    def _on_invalidate(self, patient_id: str) -> None:
+        """This process edited a board: pick the edit up now rather than at the next interval."""
+        if self._thread is not None and self._thread.is_alive():
+            self.wake()
+
+    def _on_changes(self, changes: Dict[str, Any]) -> None:
+        """Change feed subscriber: fold every new board version into the patient's pending change set."""
+        with self._pending_lock:
+            pending = self._pending.setdefault(
+                changes["patient_id"], {"added": set(), "removed": set(), "modified": set(), "initial": False}
+            )
+            pending["added"].update(changes["added"])
+            pending["removed"].update(changes["removed"])
+            pending["modified"].update(changes["modified"])
+            pending["initial"] = pending["initial"] or changes["initial"]
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                self.metrics["errors"] += 1
+                self.metrics["last_error"] = str(e)
+                print(f"Board watcher error: {e}")
+            try:
+                # Off the query path: compact the embedding store after evictions
+                embedding_store.maintenance()
+            except Exception as e:
+                print(f"Embedding store maintenance failed: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def poll(self) -> Dict[str, int]:
+        """Fetch the current patient's board once and sync the index if it changed."""
+        patient_id = patient_manager.get_patient_id().lower()
+        index = rag.rag_index.get(patient_id)
+        # An edit by this process during the poll keeps the partition stale (see _fresh)
+        marks = index.stale_marks
+        self.metrics["polls"] += 1
+        self.metrics["last_poll"] = time.time()
+
+        # Always revalidate; a 304 keeps the same snapshot version
+        snap = board_cache.snapshot(patient_id, max_age=0)
+        if snap.fetched_at < self.metrics["last_poll"]:
+            raise ConnectionError(f"board fetch failed, still on v{snap.version}")
+        version = snap.version
+        if version == self.versions.get(patient_id) and len(index) > 0:
+            self.metrics["not_modified"] += 1
+            return self._fresh(index, {}, marks)
+        # Publishes this version's change set (unless another caller already did)
+        items = canvas_ops.get_board_items(patient_id)
+        with self._pending_lock:
+            changes = self._pending.pop(patient_id, None)
+        diff = {key: len(changes[key]) for key in ("added", "removed", "modified")} if changes else {}
+        if changes and not changes["initial"] and not any(diff.values()) and len(index) > 0:
+            # New board version, but nothing the index sees changed (e.g. items moved)
+            self.metrics["unchanged"] += 1
+            self.versions[patient_id] = version
+            return self._fresh(index, {}, marks)
+
+        print(f"Board watcher [{patient_id}]: +{diff.get('added', 0)} -{diff.get('removed', 0)} ~{diff.get('modified', 0)}")
+        seen = time.time()
+        self.metrics["changes"] += 1
+        self.metrics["last_change_seen"] = seen
+        index.sync(board_items=items)
+        self.versions[patient_id] = version
+        self.metrics["last_sync_lag"] = time.time() - seen
+        return self._fresh(index, diff, marks)
+
+    def _fresh(self, index: "rag.RagIndex", diff: Dict[str, int], marks: int) -> Dict[str, int]:
+        """The partition matches the board as of now, so queries need not sync inline."""
+        now = time.time()
+        if index.stale_marks == marks:
+            index.last_sync = now
+        self.metrics["last_ok"] = now
+        return diff
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters plus staleness (seconds since the board was last confirmed in sync)."""
+        stats = dict(self.metrics)
+        stats["running"] = self._thread is not None and self._thread.is_alive()
+        stats["staleness"] = time.time() - self.metrics["last_ok"] if self.metrics["last_ok"] else None
+        return stats
+
+
+# Process-wide watcher, started from the server's startup hook
+board_watcher = BoardWatcher()
@@ -1,12 +1,14 @@
-import requests
 import json
-import time
-import aiohttp
+import asyncio
+import threading
 import helper_model
 import os
 import config
 from dotenv import load_dotenv
 from patient_manager import patient_manager
+from board_cache import board_cache
+from http_client import http_client
+from snapshot_writer import snapshot_writer
 load_dotenv()
 
 
@@ -22,105 +24,161 @@ for o in object_desc:
     object_desc_data[o['id']] = o['description']
     existing_desc_ids.append(o['id'])
 
-def board_items_process(data):
-    exclude_keys = ["x","y","width","height","createdAt","updatedAt","color","rotation", "draggable"]
-    clean_data = []
-    
+# 'updatedAt' is kept as the cheap change marker for RAG sync (rag.item_fingerprint)
+EXCLUDE_KEYS = {"x","y","width","height","createdAt","color","rotation", "draggable"}
+EXCLUDE_TYPES = {'ehrHub', 'zone', 'button'}
+CHRONOMED_DESCRIPTION = "This timeline functions similarly to a medication timeline, but with an expanded DILI assessment focus. It presents a chronological view of the patient’s clinical course, aligning multiple time-bound elements to support hepatotoxicity monitoring. Like the medication timeline tracks periods of drug exposure, this object also visualises medication start/stop dates, dose changes, and hepatotoxic risk levels. In addition, it integrates encounter history, longitudinal liver function test trends, and critical clinical events. Temporal relationships are highlighted to show how changes in medication correlate with laboratory abnormalities and clinical deterioration, providing causality links relevant to DILI analysis. The timeline is designed to facilitate retrospective assessment and ongoing monitoring by showing when key events occurred in relation to medication use and liver injury progression."
+
+def _description(d):
+    """Description to inject into a cleaned item, or None to leave it as is."""
+    d_id = d.get('id', '')
+    if 'raw' in d_id or 'single-encounter' in d_id or 'iframe' in d_id:
+        return object_desc_data.get(d_id)
+    if d_id == "dashboard-item-chronomed-2":
+        return CHRONOMED_DESCRIPTION
+    if d_id == "sidebar-1":
+        return None
+    if d.get('type') == 'component':
+        return object_desc_data.get(d_id)
+    return None
+
+def iter_board_items(data):
+    """
+    Single-pass board normalization: skips excluded types, strips UI keys and
+    injects object_desc descriptions, yielding one cleaned item at a time so
+    indexers can consume the board lazily.
+    """
     # Validate input is a list
     if not isinstance(data, list):
         print(f"⚠️ board_items_process received non-list: {type(data)}")
-        return []
-    
+        return
+
     for item in data:
         # Skip non-dict items
         if not isinstance(item, dict):
             print(f"⚠️ Skipping non-dict item: {type(item)}")
             continue
-            
-        if item.get('type') == 'ehrHub' or item.get('type') == 'zone' or item.get('type') == 'button':
-            pass
-        else:   
-            clean_item = {}
-            for k,v in item.items():
-                if k not in exclude_keys:
-                    clean_item[k] = v
-            clean_data.append(clean_item)
-
-    for d in clean_data:
-        if not d: 
+        if item.get('type') in EXCLUDE_TYPES:
             continue
-        d_id = d.get('id', '')
-        if 'raw' in d_id or 'single-encounter' in d_id or 'iframe' in d_id:
-            if d.get('id') in existing_desc_ids:
-                d['description'] = object_desc_data.get(d.get('id'), '')
-        elif d.get('id') == "dashboard-item-chronomed-2":
-            d['description'] = "This timeline functions similarly to a medication timeline, but with an expanded DILI assessment focus. It presents a chronological view of the patient’s clinical course, aligning multiple time-bound elements to support hepatotoxicity monitoring. Like the medication timeline tracks periods of drug exposure, this object also visualises medication start/stop dates, dose changes, and hepatotoxic risk levels. In addition, it integrates encounter history, longitudinal liver function test trends, and critical clinical events. Temporal relationships are highlighted to show how changes in medication correlate with laboratory abnormalities and clinical deterioration, providing causality links relevant to DILI analysis. The timeline is designed to facilitate retrospective assessment and ongoing monitoring by showing when key events occurred in relation to medication use and liver injury progression."
-        elif 'dashboard-item' in d_id:
-            if d.get('type') == 'component':
-                if d.get('id') in existing_desc_ids:
-                    d['description'] = object_desc_data.get(d.get('id'), '')
-        elif d.get('id') == "sidebar-1":
-            pass
-        elif d.get('type') == 'component':
-                if d.get('id') in existing_desc_ids:
-                    d['description'] = object_desc_data.get(d.get('id'), '')
-
-    return clean_data
-
-def get_board_items():
-    patient_id = patient_manager.get_patient_id().lower()
-    url = BASE_URL + f"/api/board-items/{patient_id}"
-    data = []
-    
-    # 1. Try fetching from API
-    try:
-        print(f"🌍 Fetching from: {url}")
-        response = requests.get(url, timeout=5)
-        
-        if response.status_code == 200:
-            try:
-                data = response.json()
-                
-                # Handle new API format: {"patientId": "...", "items": [...]}
-                if isinstance(data, dict) and 'items' in data:
-                    print(f"✅ New API format detected, extracting items")
-                    data = data['items']
-                
-                # Validate response is a list
-                if not isinstance(data, list):
-                    print(f"⚠️ API returned non-list data: {type(data)}")
-                    raise ValueError("Expected list, got " + str(type(data)))
-                
-                data = board_items_process(data)
-                # Save to cache
-                os.makedirs(config.output_dir, exist_ok=True)
-                with open(f"{config.output_dir}/board_items.json", "w", encoding="utf-8") as f:
-                    json.dump(data, f, indent=4)
-                print(f"✅ Fetched {len(data)} items from API")
+
+        clean_item = {k: v for k, v in item.items() if k not in EXCLUDE_KEYS}
+        if clean_item:
+            description = _description(clean_item)
+            if description is not None:
+                clean_item['description'] = description
+        yield clean_item
+
+def board_items_process(data):
+    return list(iter_board_items(data))
+
+def _board_items_path(patient_id):
+    return f"{config.output_dir}/boards/{patient_id.lower()}.json"
+
+def _is_current_patient(patient_id):
+    return patient_id is None or patient_id.lower() == patient_manager.get_patient_id().lower()
+
+def _save_board_items(patient_id, data):
+    # Offline fallback only: written behind the request path, debounced and atomic
+    snapshot_writer.submit(_board_items_path(patient_id), data)
+    if _is_current_patient(patient_id):
+        # Shared file other modules read for the current patient
+        snapshot_writer.submit(f"{config.output_dir}/board_items.json", data)
+
+def _load_cached_board_items(patient_id=None):
+    local_path = _board_items_path(patient_id or patient_manager.get_patient_id())
+    if not os.path.exists(local_path) and _is_current_patient(patient_id):
+        local_path = f"{config.output_dir}/board_items.json"
+    if os.path.exists(local_path):
+        print(f"📂 Falling back to local cache: {local_path}")
+        try:
+            with open(local_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+                print(f"✅ Loaded {len(data)} items from cache")
                 return data
-            except (json.JSONDecodeError, ValueError, KeyError) as e:
-                print(f"❌ Invalid JSON response from API: {e}")
-                print(f"   Response text: {response.text[:200]}...")
-        else:
-            print(f"⚠️ API Error: Status {response.status_code}")
-            print(f"   Response: {response.text[:200]}...")
-            
+        except Exception as e:
+            print(f"❌ Failed to load local cache: {e}")
+    return []
+
+def board_items_view(items):
+    """Agents' view of a board snapshot."""
+    return list(iter_board_items(items))
+
+# Change feed: last cleaned board seen per patient, and who wants to hear about changes
+_previous_boards = {}
+_subscribers = []
+_feed_lock = threading.Lock()
+
+def subscribe(callback):
+    """Call callback(changes) with the change set of every new board version get_board_items sees."""
+    with _feed_lock:
+        _subscribers.append(callback)
+
+def unsubscribe(callback):
+    with _feed_lock:
+        if callback in _subscribers:
+            _subscribers.remove(callback)
+
+def diff_board_items(previous, current):
+    """
+    Item-level change set between two cleaned boards ({id: item} each):
+    added / removed ids and, per modified id, the top-level fields that changed.
+    Items with an unchanged 'updatedAt' are taken as unchanged without comparing.
+    """
+    added = [i for i in current if i not in previous]
+    removed = [i for i in previous if i not in current]
+    modified = {}
+    for item_id, item in current.items():
+        old = previous.get(item_id)
+        if old is None or old is item:
+            continue
+        if item.get('updatedAt') is not None and old.get('updatedAt') == item.get('updatedAt'):
+            continue
+        fields = [k for k in item.keys() | old.keys() if item.get(k) != old.get(k)]
+        if fields:
+            modified[item_id] = sorted(fields)
+    return {"added": added, "removed": removed, "modified": modified}
+
+def _publish_changes(snap, data):
+    """
+    Once per new board version of a patient: queue its offline fallback files,
+    diff it against the previous version and notify subscribers.
+    """
+    with _feed_lock:
+        previous = _previous_boards.get(snap.patient_id)
+        if previous is not None and previous[0] >= snap.version:
+            return
+        current = {d['id']: d for d in data if d.get('id')}
+        changes = diff_board_items(previous[1] if previous else {}, current)
+        changes.update({"patient_id": snap.patient_id, "version": snap.version, "initial": previous is None})
+        _previous_boards[snap.patient_id] = (snap.version, current)
+        subscribers = list(_subscribers)
+    _save_board_items(snap.patient_id, data)
+    if not changes["initial"]:
+        print(f"🔄 Board v{snap.version}: +{len(changes['added'])} -{len(changes['removed'])} ~{len(changes['modified'])}")
+    for callback in subscribers:
+        try:
+            callback(changes)
+        except Exception as e:
+            print(f"⚠️ Board change subscriber failed: {e}")
+
+def get_board_items(patient_id=None, max_age=None):
+    # 1. Shared snapshot (fetched at most once per TTL, revalidated with ETag)
+    try:
+        snap = board_cache.snapshot(patient_id, max_age)
+        # iter_board_items builds new dicts, so the snapshot items need no copy
+        data = snap.view("canvas", board_items_view, copy_items=False)
+        _publish_changes(snap, data)
+        print(f"✅ {len(data)} board items")
+        return data
     except Exception as e:
         print(f"⚠️ API Connection failed: {e}")
 
         # 2. Fallback to local file
-        local_path = f"{config.output_dir}/board_items.json"
-        if os.path.exists(local_path):
-            print(f"📂 Falling back to local cache: {local_path}")
-            try:
-                with open(local_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    print(f"✅ Loaded {len(data)} items from cache")
-                    return data
-            except Exception as e:
-                print(f"❌ Failed to load local cache: {e}")
-            
-    return []
+        return _load_cached_board_items(patient_id)
+
+async def get_board_items_async(patient_id=None, max_age=None):
+    """Non-blocking get_board_items(): fetch and file I/O run on a worker thread."""
+    return await asyncio.to_thread(get_board_items, patient_id, max_age)
 
 
 async def initiate_easl_iframe(question):
@@ -136,13 +194,13 @@ async def initiate_easl_iframe(question):
     headers = {
         "Content-Type": "application/json"
     }
-    with open(f"{config.output_dir}/initiate_iframe_payload.json", "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=4)
-    response = requests.post(url, json=payload, headers=headers)
+    snapshot_writer.submit(f"{config.output_dir}/initiate_iframe_payload.json", payload)
+    response = http_client.post(url, json=payload, headers=headers)
     print("Initiate EASL iframe :", response.status_code)
+    # This process just edited the board; the next read must not serve the old snapshot
+    board_cache.invalidate()
     data = response.json()
-    with open(f"{config.output_dir}/initiate_iframe_response.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/initiate_iframe_response.json", data)
     return data
 
 async def get_agent_question(question):
@@ -180,14 +238,10 @@ async def focus_item(item_id):
         }
     }
     print("Focus URL:",url)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as response:
-            with open(f"{config.output_dir}/focus_payload.json", "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False, indent=4)
-            data = await response.json()
-            with open(f"{config.output_dir}/focus_response.json", "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-            return data
+    snapshot_writer.submit(f"{config.output_dir}/focus_payload.json", payload)
+    data = await http_client.post_json(url, payload)
+    snapshot_writer.submit(f"{config.output_dir}/focus_response.json", data)
+    return data
 
 async def create_todo(payload_body):
 
@@ -197,29 +251,23 @@ async def create_todo(payload_body):
     payload["patientId"] = patient_manager.get_patient_id()
 
     # response = requests.post(url, json=payload)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as response:
-            with open(f"{config.output_dir}/todo_payload.json", "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False, indent=4)
-            data = await response.json()
-            with open(f"{config.output_dir}/todo_response.json", "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-            return data
+    snapshot_writer.submit(f"{config.output_dir}/todo_payload.json", payload)
+    data = await http_client.post_json(url, payload)
+    board_cache.invalidate()
+    snapshot_writer.submit(f"{config.output_dir}/todo_response.json", data)
+    return data
 
 async def update_todo(payload):
     url = BASE_URL + "/api/update-todo-status"
     payload["patientId"] = patient_manager.get_patient_id()
 
     # response = requests.post(url, json=payload)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as response:
-            with open(f"{config.output_dir}/upadate_todo_payload.json", "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False, indent=4)
-            data = await response.json()
-            # print("Update todo :", data)
-            with open(f"{config.output_dir}/upadate_todo_response.json", "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-            return data
+    snapshot_writer.submit(f"{config.output_dir}/upadate_todo_payload.json", payload)
+    data = await http_client.post_json(url, payload)
+    board_cache.invalidate()
+    # print("Update todo :", data)
+    snapshot_writer.submit(f"{config.output_dir}/upadate_todo_response.json", data)
+    return data
 
 async def create_lab(payload):
    
@@ -228,16 +276,13 @@ async def create_lab(payload):
     
 
     # response = requests.post(url, json=payload)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as response:
-            with open(f"{config.output_dir}/lab_payload.json", "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/lab_payload.json", payload)
 
-            data = await response.json()
+    data = await http_client.post_json(url, payload)
+    board_cache.invalidate()
 
-            with open(f"{config.output_dir}/lab_response.json", "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-            return data
+    snapshot_writer.submit(f"{config.output_dir}/lab_response.json", data)
+    return data
 
 async def create_result(agent_result):
     url = BASE_URL + "/api/agents"
@@ -246,28 +291,24 @@ async def create_result(agent_result):
     payload["patientId"] = patient_manager.get_patient_id()
 
     # response = requests.post(url, json=payload)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as response:
-            with open(f"{config.output_dir}/agentres_payload.json", "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/agentres_payload.json", payload)
 
-            data = await response.json()
+    data = await http_client.post_json(url, payload)
+    board_cache.invalidate()
 
-            with open(f"{config.output_dir}/agentres_response.json", "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-            return data
+    snapshot_writer.submit(f"{config.output_dir}/agentres_response.json", data)
+    return data
         
 def create_diagnosis(payload):
     print("Start create object")
     url = BASE_URL + "/api/dili-diagnostic"
     payload['zone'] = "dili-analysis-zone"
     payload['patientId'] = patient_manager.get_patient_id()
-    with open(f"{config.output_dir}/diagnosis_create_payload.json", "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=4)
-    response = requests.post(url, json=payload)
+    snapshot_writer.submit(f"{config.output_dir}/diagnosis_create_payload.json", payload)
+    response = http_client.post(url, json=payload)
     print(response.status_code)
-    with open(f"{config.output_dir}/diagnosis_create_response.json", "w", encoding="utf-8") as f:
-        json.dump(response.json(), f, ensure_ascii=False, indent=4)    
+    board_cache.invalidate()
+    snapshot_writer.submit(f"{config.output_dir}/diagnosis_create_response.json", response.json())
     # async with aiohttp.ClientSession() as session:
     #     async with session.post(url, json=payload) as response:
     #         with open(f"{config.output_dir}/diagnosis_create_payload.json", "w", encoding="utf-8") as f:
@@ -285,45 +326,36 @@ async def create_report(payload):
     payload['patientId'] = patient_manager.get_patient_id()
 
     # response = requests.post(url, json=payload)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as response:
-            with open(f"{config.output_dir}/report_create_payload.json", "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/report_create_payload.json", payload)
 
-            data = await response.json()
+    data = await http_client.post_json(url, payload)
+    board_cache.invalidate()
 
-            with open(f"{config.output_dir}/report_create_response.json", "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-            return data
+    snapshot_writer.submit(f"{config.output_dir}/report_create_response.json", data)
+    return data
         
 async def create_schedule(payload):
     url = BASE_URL + "/api/schedule"
     payload["patientId"] = patient_manager.get_patient_id()
 
     # response = requests.post(url, json=payload)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as response:
-            with open(f"{config.output_dir}/schedule_create_payload.json", "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/schedule_create_payload.json", payload)
 
-            data = await response.json()
+    data = await http_client.post_json(url, payload)
+    board_cache.invalidate()
 
-            with open(f"{config.output_dir}/schedule_create_response.json", "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-            return data
+    snapshot_writer.submit(f"{config.output_dir}/schedule_create_response.json", data)
+    return data
         
 async def create_notification(payload):
     url = BASE_URL + "/api/notification"
     payload["patientId"] = patient_manager.get_patient_id()
 
     # response = requests.post(url, json=payload)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as response:
-            with open(f"{config.output_dir}/notification_create_payload.json", "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/notification_create_payload.json", payload)
 
-            data = await response.json()
+    data = await http_client.post_json(url, payload)
+    board_cache.invalidate()
 
-            with open(f"{config.output_dir}/notification_create_response.json", "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-            return data
\ No newline at end of file
+    snapshot_writer.submit(f"{config.output_dir}/notification_create_response.json", data)
+    return data
\ No newline at end of file
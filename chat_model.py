@@ -28,8 +28,8 @@ with open("system_prompts/chat_model_system.md", "r", encoding="utf-8") as f:
 async def get_answer(query :str, conversation_text: str='', context: str=''):
     if not context:
         # context = await rag_from_json(query, top_k=3)
-        context_raw = rag.run_rag(query)
-        context = json.dumps(context_raw, indent=4)
+        context_raw = await rag.run_rag_async(query)
+        context, _ = rag.build_context(context_raw)
     prompt = f"""
     Answer below user query using available data. Give output max 2 paragraph.
     User query : {query}
@@ -72,8 +72,8 @@ async def chat_agent(chat_history: list[dict]) -> str:
     
     query = chat_history[-1].get('content')
     # context = await rag_from_json(query, top_k=3)
-    context_raw = rag.run_rag(query)
-    context = json.dumps(context_raw, indent=4)
+    context_raw = await rag.run_rag_async(query)
+    context, _ = rag.build_context(context_raw)
 
     # Tools check
     print("Tools check") 
@@ -0,0 +1,318 @@
+"""
+Content-addressed embedding store shared by the retrieval modules.
+Vectors are keyed by hash(embedding model, dimensionality, normalized text),
+so identical text is embedded once no matter which item, patient or module
+it comes from. Backed by SQLite so the server and voice processes can share
+one file, with least-recently-used eviction once the store exceeds its size cap.
+Query embeddings additionally go through an in-memory LRU tier in front of the
+store, so repeated spoken phrases skip the network entirely.
+"""
+
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+STORE_PATH = "vector_cache/embedding_store.sqlite"
+# Size cap for stored vectors; least recently used rows are evicted past it
+STORE_MAX_MB = int(os.getenv("EMBEDDING_STORE_MAX_MB", "512"))
+# Only refresh last_used on hits older than this, to keep reads cheap
+TOUCH_INTERVAL = 3600
+# Inserts between exact recounts of the stored bytes (other processes write too)
+RECOUNT_INTERVAL = 1000
+# Query embeddings kept in memory per process
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so formatting-only differences share a key."""
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def normalize_query(text: str) -> str:
+    """Case- and punctuation-insensitive form of a query, so repeated phrasings share a cache key."""
+    return normalize_text(text).lower().strip(" .,!?;:\"'")
+
+
+def content_key(model: str, dim: int, text: str) -> str:
+    """Content address of an embedding."""
+    payload = f"{model}\x00{dim}\x00{normalize_text(text)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def query_key(model: str, dim: int, query: str) -> str:
+    """
+    Store key of a query embedding: its normalized form, kept apart from
+    document text so a query vector never stands in for a chunk's.
+    """
+    return content_key(model, dim, f"query\x00{normalize_query(query)}")
+
+
+class EmbeddingStore:
+    """Persistent content-addressed embedding store with size-based eviction."""
+
+    def __init__(self, path: str = STORE_PATH, max_bytes: int = STORE_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        # Evicted space not yet given back to the file system (see maintenance())
+        self.compact_pending = False
+        # Running estimate of the stored vector bytes, recounted now and then
+        self._total_bytes: Optional[int] = None
+        self._puts_since_count = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY,"
+                " model TEXT NOT NULL,"
+                " dim INTEGER NOT NULL,"
+                " vector BLOB NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, model: str, dim: int, texts: Sequence[str]) -> Dict[str, List[float]]:
+        """Return {content_key: vector} for every text already in the store."""
+        return self.get_keys([content_key(model, dim, t) for t in texts])
+
+    def get_keys(self, keys: Sequence[str]) -> Dict[str, List[float]]:
+        """Return {key: vector} for every key already in the store."""
+        key_list = list(dict.fromkeys(keys))
+        found: Dict[str, List[float]] = {}
+        stale = []
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            # Stay under SQLite's bound-parameter limit
+            for start in range(0, len(key_list), 500):
+                chunk = key_list[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT key, vector, last_used FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                for key, blob, last_used in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                    if now - last_used > TOUCH_INTERVAL:
+                        stale.append((now, key))
+            if stale:
+                conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", stale)
+                conn.commit()
+        return found
+
+    def put_many(
+        self,
+        model: str,
+        dim: int,
+        texts: Sequence[str],
+        vectors: Sequence[Optional[Sequence[float]]],
+        keys: Optional[Sequence[str]] = None,
+    ) -> None:
+        """Store vectors for texts (under their content keys unless 'keys' is given); None vectors are skipped."""
+        now = time.time()
+        if keys is None:
+            keys = [content_key(model, dim, t) for t in texts]
+        rows = [
+            (key, model, dim, np.asarray(v, dtype=np.float32).tobytes(), now)
+            for key, v in zip(keys, vectors)
+            if v is not None
+        ]
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            conn.commit()
+            self._evict(conn, sum(len(row[3]) for row in rows))
+
+    def _count_bytes(self, conn: sqlite3.Connection) -> int:
+        self._total_bytes = conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        self._puts_since_count = 0
+        return self._total_bytes
+
+    def _evict(self, conn: sqlite3.Connection, added_bytes: int) -> None:
+        """Drop least recently used vectors until the store fits its size cap."""
+        if self._total_bytes is None or self._puts_since_count >= RECOUNT_INTERVAL:
+            self._count_bytes(conn)
+        else:
+            self._total_bytes += added_bytes
+            self._puts_since_count += 1
+        if self._total_bytes <= self.max_bytes:
+            return
+        # The estimate counts replaced rows twice; only evict on an exact total
+        total = self._count_bytes(conn)
+        if total <= self.max_bytes:
+            return
+        # Evict down to 90% of the cap so we do not evict on every insert
+        excess = total - int(self.max_bytes * 0.9)
+        rows = conn.execute("SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used").fetchall()
+        victims = []
+        for key, size in rows:
+            if excess <= 0:
+                break
+            victims.append((key,))
+            excess -= size
+            total -= size
+        conn.executemany("DELETE FROM embeddings WHERE key = ?", victims)
+        conn.commit()
+        self._total_bytes = total
+        print(f"Embedding store evicted {len(victims)} vectors")
+        # Compacting rewrites the whole file, so it is left to maintenance()
+        self.compact_pending = True
+
+    def compact(self) -> None:
+        """Give the space of evicted vectors back to the file system (rewrites the database)."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.execute("VACUUM")
+            self.compact_pending = False
+
+    def maintenance(self) -> None:
+        """Background housekeeping: compact once evictions have freed space."""
+        if self.compact_pending:
+            self.compact()
+
+    def embed(
+        self,
+        model: str,
+        dim: int,
+        texts: Sequence[str],
+        embed_fn: Callable[[List[str]], List[Optional[List[float]]]],
+        refresh: bool = False,
+    ) -> List[Optional[List[float]]]:
+        """
+        Return vectors for texts in order, calling embed_fn only for texts
+        (deduplicated) that have never been embedded with this model / dim.
+        With refresh=True every text is embedded again and the stored
+        vectors are replaced (forced rebuilds).
+        """
+        if not texts:
+            return []
+        keys = [content_key(model, dim, t) for t in texts]
+        found = {} if refresh else self.get_many(model, dim, texts)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = embed_fn(list(missing.values()))
+            self.put_many(model, dim, list(missing.values()), vectors)
+            found.update({key: v for key, v in zip(missing, vectors) if v is not None})
+        print(f"Embedding store: {len(keys) - len(missing)} reused, {len(missing)} embedded")
+        return [found.get(key) for key in keys]
+
+
+class QueryEmbeddingCache:
+    """
+    Two-tier cache for query embeddings: an in-memory LRU in front of the
+    persistent store. Both tiers are keyed by the normalized query, so case
+    and trailing punctuation variants share one entry, but what gets embedded
+    is the caller's original text (the first variant seen), since case and
+    punctuation can carry meaning in clinical abbreviations.
+    """
+
+    def __init__(self, store: EmbeddingStore, max_entries: int = QUERY_CACHE_SIZE):
+        self.store = store
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def embed(
+        self,
+        model: str,
+        dim: int,
+        queries: Sequence[str],
+        embed_fn: Callable[[List[str]], List[Optional[List[float]]]],
+    ) -> List[Optional[List[float]]]:
+        """Return vectors for queries in order; only never-seen queries reach embed_fn."""
+        keys, found, rest = self._from_memory(model, dim, queries)
+        if rest:
+            on_disk = self.store.get_keys(list(rest))
+            missing = {key: text for key, text in rest.items() if key not in on_disk}
+            if missing:
+                vectors = embed_fn(list(missing.values()))
+                self.store.put_many(model, dim, list(missing.values()), vectors, keys=list(missing))
+                on_disk.update({key: v for key, v in zip(missing, vectors) if v is not None})
+            self._remember(keys, found, rest, missing, on_disk)
+        return [found.get(key) for key in keys]
+
+    async def aembed(
+        self,
+        model: str,
+        dim: int,
+        queries: Sequence[str],
+        embed_fn: Callable[[List[str]], Awaitable[List[Optional[List[float]]]]],
+    ) -> List[Optional[List[float]]]:
+        """embed() for event loops: awaits embed_fn and runs store I/O on a worker thread."""
+        keys, found, rest = self._from_memory(model, dim, queries)
+        if rest:
+            on_disk = await asyncio.to_thread(self.store.get_keys, list(rest))
+            missing = {key: text for key, text in rest.items() if key not in on_disk}
+            if missing:
+                vectors = await embed_fn(list(missing.values()))
+                await asyncio.to_thread(self.store.put_many, model, dim, list(missing.values()), vectors, list(missing))
+                on_disk.update({key: v for key, v in zip(missing, vectors) if v is not None})
+            self._remember(keys, found, rest, missing, on_disk)
+        return [found.get(key) for key in keys]
+
+    def _from_memory(self, model: str, dim: int, queries: Sequence[str]):
+        """(keys, vectors found in memory, {key: original query} still to look up)."""
+        keys = [query_key(model, dim, q) for q in queries]
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+            self.memory_hits += sum(1 for key in keys if key in found)
+        rest: Dict[str, str] = {}
+        for key, query in zip(keys, queries):
+            if key not in found and key not in rest:
+                rest[key] = query
+        return keys, found, rest
+
+    def _remember(self, keys: List[str], found: Dict[str, List[float]], rest: Dict[str, str], missing: Dict[str, str], on_disk: Dict[str, List[float]]) -> None:
+        found.update(on_disk)
+        with self._lock:
+            self.disk_hits += sum(1 for key in keys if key in rest and key not in missing)
+            self.misses += sum(1 for key in keys if key in missing)
+            for key in rest:
+                if key in on_disk:
+                    self._memory[key] = on_disk[key]
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        """Hit / miss counters since process start."""
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._memory),
+            }
+
+
+# Process-wide store (rag.py and its query cache)
+embedding_store = EmbeddingStore()
+# Query embedding cache in front of it
+query_cache = QueryEmbeddingCache(embedding_store)
@@ -20,7 +20,8 @@ import chat_model
 import side_agent
 from google.genai import types
 import helper_model
-import faiss_rag
+import rag
+from http_client import http_client
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -228,10 +229,13 @@ class AudioOnlyGeminiCable:
         return asyncio.run(self.navigate_answer_background(query))
 
     async def navigate_answer_background(self,query):
-        relevant_object = faiss_rag.rag_object(query=query)
+        # Same engine, index and embeddings as the chat path
+        results = await rag.run_rag_async(query, top_k=10)
+        relevant_object = [r["item"] for r in results]
+        if not relevant_object:
+            return "No matching item found on the board."
 
-
-        context = json.dumps(relevant_object, separators=(",", ":"))
+        context, _ = rag.build_context(results)
 
         first_object = relevant_object[0].get("id")
         print("Focus first :", first_object)
@@ -738,7 +742,12 @@ def main():
 
 
     gemini = AudioOnlyGeminiCable()
-    asyncio.run(gemini.run())
+    # One pooled canvas client for the main loop and every tool thread's asyncio.run()
+    http_client.start()
+    try:
+        asyncio.run(gemini.run())
+    finally:
+        http_client.close()
 
 # if __name__ == "__main__":
 #     main()
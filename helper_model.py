@@ -2,10 +2,10 @@ import os
 import google.generativeai as genai
 import requests
 import config
-import httpx
 import json
 from dotenv import load_dotenv
 from patient_manager import patient_manager
+from board_cache import board_cache
 load_dotenv()
 
 
@@ -33,19 +33,9 @@ with open("system_prompts/question_gen.md", "r", encoding="utf-8") as f:
 
 async def load_ehr():
     print("Start load_ehr")
-    patient_id = patient_manager.get_patient_id().lower()
-    url = BASE_URL + f"/api/board-items/{patient_id}"
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        print(f"Status code: {response.status_code}")
-        data = response.json()
-        
-        # Handle new API format: {"patientId": "...", "items": [...]}
-        if isinstance(data, dict) and 'items' in data:
-            data = data['items']
-        
-        return data
+    # Shared board snapshot (raw items)
+    snapshot = await board_cache.snapshot_async()
+    return snapshot.items
 
 async def generate_response(todo_obj):
     model = genai.GenerativeModel(
@@ -0,0 +1,127 @@
+"""
+Process-wide pooled HTTP client for the canvas API.
+One keep-alive aiohttp session lives on a dedicated I/O event loop thread, so
+coroutines from any loop (the server's, the voice process's, or the
+short-lived loops of asyncio.run() in worker threads) share one connection
+pool instead of paying DNS, TCP and TLS setup per call. Blocking callers
+(board_cache, the create_* helpers) share one pooled requests.Session.
+Limits and timeouts come from the environment; start() / close() are called
+from the server and voice process startup / shutdown hooks, and the client
+also starts lazily on first use.
+"""
+
+import asyncio
+import os
+import threading
+from typing import Any, Optional
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+# Connection pool limits (total and per canvas host)
+HTTP_POOL_LIMIT = int(os.getenv("CANVAS_HTTP_POOL_LIMIT", "32"))
+HTTP_POOL_PER_HOST = int(os.getenv("CANVAS_HTTP_POOL_PER_HOST", "16"))
+# Seconds an idle keep-alive connection is kept open
+HTTP_KEEPALIVE = float(os.getenv("CANVAS_HTTP_KEEPALIVE", "60"))
+# Seconds to connect, and for a whole request
+HTTP_CONNECT_TIMEOUT = float(os.getenv("CANVAS_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_TIMEOUT = float(os.getenv("CANVAS_HTTP_TIMEOUT", "30"))
+
+
+class CanvasHttpClient:
+    """Pooled keep-alive client shared by every canvas caller in the process."""
+
+    def __init__(
+        self,
+        limit: int = HTTP_POOL_LIMIT,
+        limit_per_host: int = HTTP_POOL_PER_HOST,
+        keepalive: float = HTTP_KEEPALIVE,
+        connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+        timeout: float = HTTP_TIMEOUT,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = threading.Lock()
+        # Blocking callers; requests keeps one pool of up to pool_maxsize
+        # connections per host, for up to pool_connections hosts. pool_block
+        # makes a caller wait for a free connection once its host's pool is
+        # in use, instead of opening (and then discarding) extra ones
+        self.sync = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(1, limit // limit_per_host), pool_maxsize=limit_per_host, pool_block=True)
+        self.sync.mount("http://", adapter)
+        self.sync.mount("https://", adapter)
+
+    def start(self) -> None:
+        """Start the I/O loop thread and open the shared session (idempotent)."""
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="canvas-http", daemon=True)
+            thread.start()
+            self._session = asyncio.run_coroutine_threadsafe(self._open(), loop).result()
+            self._loop, self._thread = loop, thread
+            print(f"Canvas HTTP pool started (limit {self.limit}, {self.limit_per_host} per host)")
+
+    async def _open(self) -> aiohttp.ClientSession:
+        # The session must be created on the loop that will use it
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive,
+            ttl_dns_cache=300,
+        )
+        timeout = aiohttp.ClientTimeout(total=self.timeout, connect=self.connect_timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    def close(self) -> None:
+        """Close pooled connections and stop the I/O loop; a later request starts it again."""
+        with self._lock:
+            loop, thread, session = self._loop, self._thread, self._session
+            self._loop = self._thread = self._session = None
+        if loop is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout=self.connect_timeout)
+            except Exception as e:
+                print(f"⚠️ Canvas HTTP pool did not close cleanly: {e}")
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout=self.connect_timeout)
+            loop.close()
+        self.sync.close()
+
+    async def _request_json(self, method: str, url: str, **kwargs: Any) -> Any:
+        async with self._session.request(method, url, **kwargs) as response:
+            return await response.json()
+
+    async def request_json(self, method: str, url: str, **kwargs: Any) -> Any:
+        """
+        Send a request over the shared pool from any event loop and return the
+        decoded JSON body. Cancelling the caller cancels the request.
+        """
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(self._request_json(method, url, **kwargs), self._loop)
+        return await asyncio.wrap_future(future)
+
+    async def post_json(self, url: str, payload: Any) -> Any:
+        return await self.request_json("POST", url, json=payload)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        """Blocking POST over the shared requests pool."""
+        kwargs.setdefault("timeout", (self.connect_timeout, self.timeout))
+        return self.sync.post(url, **kwargs)
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        """Blocking GET over the shared requests pool."""
+        kwargs.setdefault("timeout", (self.connect_timeout, self.timeout))
+        return self.sync.get(url, **kwargs)
+
+
+# Process-wide client
+http_client = CanvasHttpClient()
@@ -3,19 +3,30 @@ RAG (Retrieval Augmented Generation) module for medical board items.
 Provides semantic search over patient data, lab results, medications, and clinical notes.
 """
 
+import asyncio
 import json
 import os
 import pickle
 import hashlib
-from typing import List, Dict, Any, Optional, Tuple
+import threading
+import heapq
+import math
+import mmap
+import re
+from collections import OrderedDict
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Dict, Any, Optional, Tuple, Union
 from dotenv import load_dotenv
 from google import genai
 from google.genai.types import EmbedContentConfig
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
 import canvas_ops
+from board_cache import board_cache
 import time
+from patient_manager import patient_manager
+from embedding_store import embedding_store, normalize_query, query_cache
 
 load_dotenv()
 
@@ -24,7 +35,56 @@ PROJECT_ID = os.getenv("PROJECT_ID")
 PROJECT_LOCATION = os.getenv("PROJECT_LOCATION", "us-central1")
 EMBEDDING_MODEL = "text-embedding-005"
 EMBEDDING_DIM = 768
-INDEX_CACHE_PATH = "vector_cache/rag_index.pkl"
+INDEX_DIR = "vector_cache/rag_index"
+LEGACY_INDEX_PATH = "vector_cache/rag_index.pkl"
+# faiss_rag's old object cache: text-embedding-004 vectors of whole objects, not importable
+LEGACY_OBJECT_CACHE_PATH = "vector_cache/embedding_cache.pkl"
+META_FILE = "meta.json"
+# Bumped whenever the on-disk layout changes (normalized vectors, chunk rows)
+INDEX_FORMAT = 2
+# Rows scored per block when streaming over the memory-mapped matrix
+SEARCH_BLOCK_ROWS = int(os.getenv("RAG_SEARCH_BLOCK_ROWS", "8192"))
+# Batched embedding limits (Vertex allows 250 texts / ~20k tokens per request)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "18000"))
+EMBED_MAX_TEXT_TOKENS = 2048
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_MAX_RETRIES = 5
+# Seconds a synced index is trusted before a query triggers a re-sync
+RAG_SYNC_INTERVAL = float(os.getenv("RAG_SYNC_INTERVAL", "60"))
+# "item" embeds each board item as one text; "field" splits large items into
+# bounded chunks along their field structure (encounters, labs, medications)
+RAG_CHUNK_MODE = os.getenv("RAG_CHUNK_MODE", "item")
+RAG_CHUNK_MAX_CHARS = int(os.getenv("RAG_CHUNK_MAX_CHARS", "1500"))
+# Chunk rows fetched per requested item before aggregating scores per item
+RAG_CHUNK_CANDIDATES = 4
+# Optional compressed first-pass matrix: "float32" (off), "float16" or "int8".
+# Top candidates are always re-scored against the full-precision vectors.
+RAG_VECTOR_DTYPE = os.getenv("RAG_VECTOR_DTYPE", "float32")
+# First-pass candidates per requested result when searching quantized vectors
+RAG_RERANK_FACTOR = int(os.getenv("RAG_RERANK_FACTOR", "4"))
+# Dense index backend: "exact" (NumPy scan) or "ivf" (inverted file with
+# k-means coarse centroids, used once a partition has RAG_IVF_MIN_ROWS rows)
+RAG_ANN_BACKEND = os.getenv("RAG_ANN_BACKEND", "exact")
+RAG_IVF_MIN_ROWS = int(os.getenv("RAG_IVF_MIN_ROWS", "2000"))
+RAG_IVF_NLIST = int(os.getenv("RAG_IVF_NLIST", "0"))
+RAG_IVF_NPROBE = int(os.getenv("RAG_IVF_NPROBE", "8"))
+# "hybrid" fuses BM25 with cosine similarity, "dense" is vector-only
+RAG_SEARCH_MODE = os.getenv("RAG_SEARCH_MODE", "hybrid")
+# Weight of the (max-normalized) BM25 score in the fused hybrid score
+RAG_LEXICAL_WEIGHT = float(os.getenv("RAG_LEXICAL_WEIGHT", "0.3"))
+# Lexical fast path: answer without a query embedding when the best BM25 hit
+# matches every query term and beats the runner-up by this factor
+RAG_LEXICAL_MARGIN = float(os.getenv("RAG_LEXICAL_MARGIN", "1.5"))
+RAG_LEXICAL_MAX_TERMS = 4
+# Cached result lists per partition, keyed by (normalized query, top_k, index version)
+RAG_RESULT_CACHE_SIZE = int(os.getenv("RAG_RESULT_CACHE_SIZE", "256"))
+# Token budget for the retrieved context placed in LLM prompts
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "3000"))
+# Item fields dropped first when the context does not fit its budget
+CONTEXT_LOW_VALUE_KEYS = {'zone', 'imageUrl', 'iframeUrl', 'dataSource', 'encounterIndex'}
+# Resident memory cap across per-patient index partitions
+RAG_PARTITION_MEMORY_MB = int(os.getenv("RAG_PARTITION_MEMORY_MB", "256"))
 
 # Initialize client
 client = genai.Client(
@@ -34,22 +94,39 @@ client = genai.Client(
 )
 
 
-def load_board_items(file_path: str = "output/board_items.json") -> List[Dict[str, Any]]:
-    """Load board items from Canvas Ops or fallback to JSON file."""
+def _read_board_file(file_path: str, patient_id: Optional[str]) -> List[Dict[str, Any]]:
+    """The shared board file only ever holds the current patient's board."""
+    if patient_id is not None and patient_id.lower() != patient_manager.get_patient_id().lower():
+        return []
+    if not os.path.exists(file_path):
+        return []
+    with open(file_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_board_items(file_path: str = "output/board_items.json", patient_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Load a patient's board items (default: current patient) from Canvas Ops or fallback to JSON file."""
     try:
-        items = canvas_ops.get_board_items()
+        items = canvas_ops.get_board_items(patient_id)
         if items:
             return items
         # Fallback if canvas_ops returns empty
         print("Canvas returned empty, falling back to file.")
-        with open(file_path, "r", encoding="utf-8") as f:
-            return json.load(f)
     except Exception as e:
         print(f"Error loading board items: {e}")
-        if os.path.exists(file_path):
-            with open(file_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        return []
+    return _read_board_file(file_path, patient_id)
+
+
+async def load_board_items_async(file_path: str = "output/board_items.json", patient_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """load_board_items() without blocking the event loop."""
+    try:
+        items = await canvas_ops.get_board_items_async(patient_id)
+        if items:
+            return items
+        print("Canvas returned empty, falling back to file.")
+    except Exception as e:
+        print(f"Error loading board items: {e}")
+    return await asyncio.to_thread(_read_board_file, file_path, patient_id)
 
 
 def compute_item_hash(item: Dict[str, Any]) -> str:
@@ -60,27 +137,336 @@ def compute_item_hash(item: Dict[str, Any]) -> str:
     return hashlib.md5(item_str.encode()).hexdigest()
 
 
-def save_index(index_df: pd.DataFrame, file_path: str = INDEX_CACHE_PATH) -> None:
-    """Save index to disk."""
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, "wb") as f:
-        pickle.dump(index_df, f)
-    print(f"Index saved to {file_path}")
+def item_fingerprint(item: Dict[str, Any]) -> Optional[str]:
+    """Cheap change marker: the canvas 'updatedAt' stamp when the item carries one."""
+    updated_at = item.get("updatedAt")
+    return str(updated_at) if updated_at else None
 
 
-def load_index(file_path: str = INDEX_CACHE_PATH) -> Optional[pd.DataFrame]:
-    """Load index from disk if it exists."""
-    if os.path.exists(file_path):
-        try:
-            with open(file_path, "rb") as f:
-                index_df = pickle.load(f)
-            # Ensure strictly a DataFrame
-            if isinstance(index_df, pd.DataFrame):
-                return index_df
-        except Exception as e:
-            print(f"Error loading index: {e}")
+def _index_file(index_dir: str, name: str) -> str:
+    return os.path.join(index_dir, name)
+
+
+def load_index(index_dir: str) -> Optional[Tuple[Dict[str, Any], np.ndarray]]:
+    """
+    Open the on-disk index.
+    Returns (meta, matrix) where matrix is a read-only float32 memmap, so the
+    load is zero-copy and every worker shares the same page-cached file.
+    """
+    meta_path = _index_file(index_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format") != INDEX_FORMAT:
+            # Older layouts are rebuilt; vectors come back from the embedding store
+            print("Index uses an older on-disk format, ignoring it.")
             return None
-    return None
+        if meta.get("model") != EMBEDDING_MODEL or meta.get("dim") != EMBEDDING_DIM:
+            print("Index was built with a different embedding model, ignoring it.")
+            return None
+        if meta.get("chunk_mode", "item") != RAG_CHUNK_MODE:
+            print(f"Index was built in '{meta.get('chunk_mode', 'item')}' chunk mode, ignoring it.")
+            return None
+        matrix = np.load(_index_file(index_dir, meta["vectors"]), mmap_mode="r")
+        if matrix.shape[0] != len(meta["ids"]):
+            print("Index vectors and sidecar disagree, ignoring it.")
+            return None
+        return meta, matrix
+    except Exception as e:
+        print(f"Error loading index: {e}")
+        return None
+
+
+def normalize_vector(vector) -> np.ndarray:
+    """L2-normalize a vector as float32 (zero vectors are left as-is)."""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def quantize(matrix: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Compress unit vectors for the first search pass.
+    'float16' halves the size; 'int8' uses symmetric per-row scales
+    (value ~= q * scale) for a quarter of the float32 size.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dtype == "float16":
+        return matrix.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(matrix / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    raise ValueError(f"Unsupported RAG_VECTOR_DTYPE: {dtype}")
+
+
+def quantized_scores(qmatrix: np.ndarray, scales: Optional[np.ndarray], query_vec: np.ndarray) -> np.ndarray:
+    """Approximate dot products of a query (or a (dim, queries) matrix) against a block of quantized rows."""
+    scores = qmatrix.astype(np.float32) @ query_vec
+    if scales is None:
+        return scores
+    return scores * (scales[:, None] if scores.ndim == 2 else scales)
+
+
+def _save_quantized(vectors: np.ndarray, index_dir: str, version: int, dtype: str) -> Dict[str, str]:
+    """Write the compressed copy of a freshly written float32 matrix, block by block."""
+    qvectors_name = f"qvectors-{version}.npy"
+    qvectors = np.lib.format.open_memmap(
+        _index_file(index_dir, qvectors_name), mode="w+", dtype=np.float16 if dtype == "float16" else np.int8, shape=vectors.shape
+    )
+    scales = np.ones(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), SEARCH_BLOCK_ROWS):
+        block, block_scales = quantize(vectors[start:start + SEARCH_BLOCK_ROWS], dtype)
+        qvectors[start:start + len(block)] = block
+        if block_scales is not None:
+            scales[start:start + len(block)] = block_scales
+    qvectors.flush()
+    del qvectors
+    quantized = {"dtype": dtype, "vectors": qvectors_name}
+    if dtype == "int8":
+        quantized["scales"] = f"scales-{version}.npy"
+        np.save(_index_file(index_dir, quantized["scales"]), scales)
+    return quantized
+
+
+def train_ivf(matrix: np.ndarray, nlist: int, iterations: int = 10, seed: int = 0, sample: int = 50000) -> np.ndarray:
+    """Spherical k-means over unit vectors; returns (nlist, dim) unit centroids."""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(matrix), size=min(sample, len(matrix)), replace=False)
+    data = np.asarray(matrix[np.sort(rows)], dtype=np.float32)
+    nlist = max(1, min(nlist, len(data)))
+    centroids = data[rng.choice(len(data), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(data @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        counts = np.bincount(assign, minlength=nlist)
+        # Re-seed empty lists with random points
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = data[rng.choice(len(data), size=int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = sums / norms
+    return centroids.astype(np.float32)
+
+
+def assign_ivf(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Nearest centroid per row, computed block by block."""
+    assign = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), SEARCH_BLOCK_ROWS):
+        block = np.asarray(matrix[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+        assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+class IVFIndex:
+    """Inverted-file ANN index: coarse centroids plus the matrix rows of each list."""
+
+    def __init__(self, centroids: np.ndarray, assign: np.ndarray, trained_rows: int):
+        self.centroids = centroids
+        self.assign = assign
+        self.trained_rows = trained_rows
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+        self.lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(centroids))]
+
+    def needs_retrain(self, rows: int) -> bool:
+        """Centroids drift as the board grows or shrinks a lot since training."""
+        return rows > 2 * self.trained_rows or rows < self.trained_rows // 2
+
+    def candidates(self, query_vec: np.ndarray, nprobe: int) -> np.ndarray:
+        """Matrix rows in the nprobe lists closest to the query."""
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(self.centroids @ query_vec, -nprobe)[-nprobe:]
+        return np.sort(np.concatenate([self.lists[c] for c in probes]))
+
+
+def ivf_nlist(rows: int) -> int:
+    """Default number of coarse lists (~sqrt(N)) unless RAG_IVF_NLIST is set."""
+    return RAG_IVF_NLIST or max(1, int(math.sqrt(rows)))
+
+
+def _save_ivf(vectors: np.ndarray, source_rows: List[int], source: Optional["IndexVersion"], index_dir: str, version: int) -> Dict[str, Any]:
+    """
+    Keep the IVF index in step with a new index version: rows carried over
+    from 'source' keep their list, new rows are assigned to the nearest
+    centroid and removed rows simply drop out. Centroids are retrained only
+    when the row count drifts too far from the training size.
+    """
+    previous = source.ivf if source is not None else None
+    if previous is None or previous.needs_retrain(len(vectors)):
+        print(f"Training IVF index ({ivf_nlist(len(vectors))} lists over {len(vectors)} rows)")
+        centroids = train_ivf(vectors, ivf_nlist(len(vectors)))
+        assign = assign_ivf(vectors, centroids)
+        trained_rows = len(vectors)
+    else:
+        centroids, trained_rows = previous.centroids, previous.trained_rows
+        source_rows = np.asarray(source_rows)
+        assign = np.empty(len(vectors), dtype=np.int32)
+        carried = source_rows >= 0
+        assign[carried] = previous.assign[source_rows[carried]]
+        new_rows = np.flatnonzero(~carried)
+        if len(new_rows):
+            assign[new_rows] = assign_ivf(vectors[new_rows], centroids)
+    ivf = {"centroids": f"centroids-{version}.npy", "assign": f"assign-{version}.npy", "trained_rows": trained_rows}
+    np.save(_index_file(index_dir, ivf["centroids"]), centroids)
+    np.save(_index_file(index_dir, ivf["assign"]), assign)
+    return ivf
+
+
+def save_index(rows: List[Dict[str, Any]], index_dir: str, source: Optional["IndexVersion"] = None) -> Dict[str, Any]:
+    """
+    Write a new index version and return its sidecar.
+    Each row is one board item and either carries fresh 'text' / 'item' /
+    'chunks' plus one vector per chunk in 'embeddings', or the matrix 'rows'
+    of that item in 'source', whose vectors and record bytes are copied as-is.
+    Every matrix row is one chunk; the sidecar maps it back to its item
+    record. Vectors are stored L2-normalized so search is a plain dot product.
+    Data files are versioned and meta.json is replaced last, so readers never
+    see a half-written index.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    # Monotonic even if the clock steps back or two saves land in one millisecond
+    version = max(int(time.time() * 1000), (source.version + 1) if source is not None else 0)
+    vectors_name = f"vectors-{version}.npy"
+    items_name = f"items-{version}.jsonl"
+
+    total_rows = sum(len(row["embeddings"]) if "embeddings" in row else len(row["rows"]) for row in rows)
+    vectors = np.lib.format.open_memmap(
+        _index_file(index_dir, vectors_name + ".tmp"), mode="w+", dtype=np.float32, shape=(total_rows, EMBEDDING_DIM)
+    )
+    meta = {
+        "model": EMBEDDING_MODEL,
+        "dim": EMBEDDING_DIM,
+        "format": INDEX_FORMAT,
+        "version": version,
+        "chunk_mode": RAG_CHUNK_MODE,
+        "vectors": vectors_name,
+        "items": items_name,
+        "ids": [],
+        "hashes": [],
+        "chunks": [],
+        "offsets": [],
+        "lengths": [],
+    }
+    # Row in 'source' each new row was copied from (-1 for fresh vectors)
+    source_rows: List[int] = []
+    with open(_index_file(index_dir, items_name + ".tmp"), "wb") as items_file:
+        for run in _row_runs(rows):
+            i, offset = len(source_rows), items_file.tell()
+            if isinstance(run, range):
+                # Carried items with consecutive source rows: their vectors and
+                # records are contiguous in 'source', copy them as one block
+                start, stop = run.start, run.stop
+                src_offset = source.meta["offsets"][start]
+                src_end = source.meta["offsets"][stop - 1] + source.meta["lengths"][stop - 1]
+                vectors[i:i + len(run)] = source.matrix[start:stop]
+                items_file.write(source.records[src_offset:src_end])
+                for key in ("ids", "hashes", "chunks", "lengths"):
+                    meta[key].extend(source.meta[key][start:stop])
+                meta["offsets"].extend(o - src_offset + offset for o in source.meta["offsets"][start:stop])
+                source_rows.extend(run)
+                continue
+            row = run
+            record = {"id": row["id"], "text": row["text"], "item": row["item"]}
+            if row["chunks"] != [row["text"]]:
+                record["chunks"] = row["chunks"]
+            record_bytes = json.dumps(record).encode("utf-8") + b"\n"
+            items_file.write(record_bytes)
+            n = len(row["embeddings"])
+            for chunk_index, vector in enumerate(row["embeddings"]):
+                vectors[i + chunk_index] = normalize_vector(vector)
+            meta["ids"].extend([row["id"]] * n)
+            meta["hashes"].extend([row["hash"]] * n)
+            meta["chunks"].extend(range(n))
+            meta["offsets"].extend([offset] * n)
+            meta["lengths"].extend([len(record_bytes)] * n)
+            source_rows.extend([-1] * n)
+    vectors.flush()
+    if RAG_VECTOR_DTYPE != "float32" and total_rows:
+        meta["quantized"] = _save_quantized(vectors, index_dir, version, RAG_VECTOR_DTYPE)
+    if RAG_ANN_BACKEND == "ivf" and total_rows >= RAG_IVF_MIN_ROWS:
+        meta["ivf"] = _save_ivf(vectors, source_rows, source, index_dir, version)
+    del vectors
+
+    os.replace(_index_file(index_dir, vectors_name + ".tmp"), _index_file(index_dir, vectors_name))
+    os.replace(_index_file(index_dir, items_name + ".tmp"), _index_file(index_dir, items_name))
+    meta_tmp = _index_file(index_dir, META_FILE + ".tmp")
+    with open(meta_tmp, "w", encoding="utf-8") as f:
+        # dumps() uses the C encoder, dump() streams through the Python one
+        f.write(json.dumps(meta, separators=(",", ":")))
+    os.replace(meta_tmp, _index_file(index_dir, META_FILE))
+    # Other workers may still be about to open the previous version, so it stays on disk
+    _remove_stale_index_files(index_dir, keep=_version_files(meta) | (_version_files(source.meta) if source is not None else set()))
+    print(f"Index saved to {index_dir} ({len(rows)} items, {total_rows} vectors)")
+    return meta
+
+
+def _row_runs(rows: List[Dict[str, Any]]) -> Iterator[Union[Dict[str, Any], range]]:
+    """
+    Yield save_index() rows in order, merging carried rows whose 'source'
+    rows follow on from each other into one range of source rows (fresh rows
+    are yielded as-is).
+    """
+    run: Optional[range] = None
+    for row in rows:
+        if "embeddings" not in row:
+            start, stop = row["rows"][0], row["rows"][-1] + 1
+            if run is not None and run.stop == start:
+                run = range(run.start, stop)
+                continue
+            if run is not None:
+                yield run
+            run = range(start, stop)
+            continue
+        if run is not None:
+            yield run
+            run = None
+        yield row
+    if run is not None:
+        yield run
+
+
+def _version_files(meta: Dict[str, Any]) -> set:
+    """Data files an index version's sidecar points at."""
+    files = {meta[key] for key in ("vectors", "items") if key in meta}
+    files.update(v for k, v in meta.get("quantized", {}).items() if k != "dtype")
+    if "ivf" in meta:
+        files.update((meta["ivf"]["centroids"], meta["ivf"]["assign"]))
+    return files
+
+
+def _remove_stale_index_files(index_dir: str, keep: set) -> None:
+    """Best-effort cleanup of older index versions (files still mapped elsewhere are skipped)."""
+    for name in os.listdir(index_dir):
+        if name.startswith(("vectors-", "items-", "qvectors-", "scales-", "centroids-", "assign-")) and name not in keep and not name.endswith(".tmp"):
+            try:
+                os.remove(_index_file(index_dir, name))
+            except OSError:
+                pass
+
+
+def migrate_legacy_index(file_path: str = LEGACY_INDEX_PATH) -> None:
+    """Seed the embedding store from the old pickled DataFrame cache so nothing is re-embedded."""
+    if not os.path.exists(file_path):
+        return
+    try:
+        with open(file_path, "rb") as f:
+            index_df = pickle.load(f)
+        if isinstance(index_df, pd.DataFrame) and not index_df.empty:
+            embedding_store.put_many(EMBEDDING_MODEL, EMBEDDING_DIM, index_df["text"].tolist(), index_df["embeddings"].tolist())
+            print(f"Migrated {len(index_df)} embeddings from {file_path}")
+    except Exception as e:
+        print(f"Error loading legacy index: {e}")
+
+
+# UI-specific keys that confuse the RAG
+UI_KEYS = {'x', 'y', 'width', 'height', 'color', 'rotation', 'createdAt', 'updatedAt', 'style', 'zIndex'}
+# Short identifying fields repeated at the start of every chunk of an item
+CHUNK_HEADER_KEYS = ('id', 'type', 'componentType', 'title')
 
 
 def extract_text_recursive(obj: Any, parent_key: str = "") -> List[str]:
@@ -90,7 +476,7 @@ def extract_text_recursive(obj: Any, parent_key: str = "") -> List[str]:
     if isinstance(obj, dict):
         for key, value in obj.items():
             # Skip UI-specific keys that confuse the RAG
-            if key in ['x', 'y', 'width', 'height', 'color', 'rotation', 'createdAt', 'updatedAt', 'style', 'zIndex']:
+            if key in UI_KEYS:
                 continue
             
             full_key = f"{parent_key}.{key}" if parent_key else key
@@ -116,188 +502,1195 @@ def extract_searchable_text(item: Dict[str, Any]) -> str:
     return " | ".join(text_parts)
 
 
+def _field_units(value: Any, key: str, max_chars: int) -> List[str]:
+    """Split one field into text units along its structure, each within max_chars where possible."""
+    if isinstance(value, (dict, list)):
+        text = " | ".join(extract_text_recursive(value, key))
+    else:
+        text = f"{key}: {value}" if value is not None and str(value).strip() else ""
+    if len(text) <= max_chars:
+        return [text] if text else []
+
+    units = []
+    if isinstance(value, list):
+        # One unit per encounter / lab panel / medication entry
+        for element in value:
+            units.extend(_field_units(element, key, max_chars))
+    elif isinstance(value, dict):
+        for child_key, child in value.items():
+            if child_key not in UI_KEYS:
+                units.extend(_field_units(child, f"{key}.{child_key}", max_chars))
+    else:
+        units.extend(text[start:start + max_chars] for start in range(0, len(text), max_chars))
+    return units
+
+
+def extract_chunks(item: Dict[str, Any]) -> Tuple[str, List[str]]:
+    """
+    Return (searchable_text, chunks) for a board item.
+    In 'item' mode (or for small items) the only chunk is the full text. In
+    'field' mode large items are split along their fields into chunks of at
+    most RAG_CHUNK_MAX_CHARS, each prefixed with the item's identifying fields.
+    """
+    text = extract_searchable_text(item)
+    if not text.strip():
+        return text, []
+    if RAG_CHUNK_MODE != "field" or len(text) <= RAG_CHUNK_MAX_CHARS:
+        return text, [text]
+
+    header = " | ".join(f"{k}: {item[k]}" for k in CHUNK_HEADER_KEYS if isinstance(item.get(k), str))
+    budget = max(200, RAG_CHUNK_MAX_CHARS - len(header))
+    units = []
+    for key, value in item.items():
+        if key not in UI_KEYS and key not in CHUNK_HEADER_KEYS:
+            units.extend(_field_units(value, key, budget))
+
+    # Pack consecutive small units together up to the budget
+    chunks, current = [], ""
+    for unit in units:
+        if current and len(current) + len(unit) + 3 > budget:
+            chunks.append(current)
+            current = ""
+        current = f"{current} | {unit}" if current else unit
+    if current:
+        chunks.append(current)
+    return text, [f"{header} | {chunk}" if header else chunk for chunk in chunks] or [text]
+
+
+class _RateLimitBackoff:
+    """Shared delay between embedding calls that grows on 429s and decays on success."""
+
+    def __init__(self, initial: float = 0.0, maximum: float = 30.0):
+        self.delay = initial
+        self.maximum = maximum
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if self.delay > 0:
+            time.sleep(self.delay * random.uniform(0.8, 1.2))
+
+    async def wait_async(self) -> None:
+        if self.delay > 0:
+            await asyncio.sleep(self.delay * random.uniform(0.8, 1.2))
+
+    def throttled(self) -> None:
+        with self._lock:
+            self.delay = min(self.maximum, max(0.5, self.delay * 2))
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > 0.05 else 0.0
+
+
+_backoff = _RateLimitBackoff()
+
+
+def _is_rate_limited(error: Exception) -> bool:
+    """True for 429 / RESOURCE_EXHAUSTED responses from the embedding API."""
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return code == 429 or "429" in str(error) or "RESOURCE_EXHAUSTED" in str(error)
+
+
+def _embed_batch(texts: List[str], output_dim: int = EMBEDDING_DIM) -> List[Optional[List[float]]]:
+    """Embed one batch of texts in a single request, retrying with backoff on rate limits."""
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        _backoff.wait()
+        try:
+            response = client.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=texts,
+                config=EmbedContentConfig(output_dimensionality=output_dim),
+            )
+            _backoff.succeeded()
+            return [e.values for e in response.embeddings]
+        except Exception as e:
+            if _is_rate_limited(e) and attempt < EMBED_MAX_RETRIES:
+                _backoff.throttled()
+                print(f"Embedding rate limited, retrying in ~{_backoff.delay:.1f}s ({attempt + 1}/{EMBED_MAX_RETRIES})")
+                continue
+            print(f"Error generating embeddings: {e}")
+            return [None] * len(texts)
+    return [None] * len(texts)
+
+
+async def _embed_batch_async(texts: List[str], output_dim: int = EMBEDDING_DIM) -> List[Optional[List[float]]]:
+    """_embed_batch() on the async client, sharing the same rate-limit backoff."""
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        await _backoff.wait_async()
+        try:
+            response = await client.aio.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=texts,
+                config=EmbedContentConfig(output_dimensionality=output_dim),
+            )
+            _backoff.succeeded()
+            return [e.values for e in response.embeddings]
+        except Exception as e:
+            if _is_rate_limited(e) and attempt < EMBED_MAX_RETRIES:
+                _backoff.throttled()
+                print(f"Embedding rate limited, retrying in ~{_backoff.delay:.1f}s ({attempt + 1}/{EMBED_MAX_RETRIES})")
+                continue
+            print(f"Error generating embeddings: {e}")
+            return [None] * len(texts)
+    return [None] * len(texts)
+
+
+def count_tokens(text: str) -> int:
+    """Conservative token estimate (~3 chars per token)."""
+    return len(text) // 3 + 1
+
+
+def estimate_tokens(text: str) -> int:
+    """count_tokens(), capped at the embedding model's per-text truncation."""
+    return min(EMBED_MAX_TEXT_TOKENS, count_tokens(text))
+
+
+def make_batches(texts: List[str], max_items: int = None, max_tokens: int = None) -> List[List[int]]:
+    """Group text indices into batches bounded by item count and estimated tokens."""
+    max_items = max_items or EMBED_BATCH_SIZE
+    max_tokens = max_tokens or EMBED_BATCH_TOKENS
+    batches, current, current_tokens = [], [], 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if current and (len(current) >= max_items or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def get_embeddings_batch(texts: List[str], output_dim: int = EMBEDDING_DIM) -> List[Optional[List[float]]]:
+    """Embed many texts using batched requests with bounded concurrency. Order is preserved."""
+    results: List[Optional[List[float]]] = [None] * len(texts)
+    batches = make_batches(texts)
+    if not batches:
+        return results
+
+    def run(batch: List[int]) -> None:
+        vectors = _embed_batch([texts[i] for i in batch], output_dim)
+        for i, vector in zip(batch, vectors):
+            results[i] = vector
+
+    workers = max(1, min(EMBED_CONCURRENCY, len(batches)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(run, batches))
+    print(f"Embedded {len(texts)} texts in {len(batches)} request(s)")
+    return results
+
+
+async def get_embeddings_batch_async(texts: List[str], output_dim: int = EMBEDDING_DIM) -> List[Optional[List[float]]]:
+    """get_embeddings_batch() on the event loop: batches run as concurrent requests."""
+    results: List[Optional[List[float]]] = [None] * len(texts)
+    batches = make_batches(texts)
+    if not batches:
+        return results
+    limit = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+    async def run(batch: List[int]) -> None:
+        async with limit:
+            vectors = await _embed_batch_async([texts[i] for i in batch], output_dim)
+        for i, vector in zip(batch, vectors):
+            results[i] = vector
+
+    await asyncio.gather(*(run(batch) for batch in batches))
+    print(f"Embedded {len(texts)} texts in {len(batches)} request(s)")
+    return results
+
+
 def get_embeddings(text: str, output_dim: int = EMBEDDING_DIM) -> Optional[List[float]]:
-    """Generate embeddings for text using Vertex AI."""
-    try:
-        # Rate limit protection (simple sleep)
-        time.sleep(0.05) 
-        response = client.models.embed_content(
-            model=EMBEDDING_MODEL,
-            contents=[text],
-            config=EmbedContentConfig(output_dimensionality=output_dim),
-        )
-        return response.embeddings[0].values
-    except Exception as e:
-        print(f"Error generating embeddings: {e}")
-        return None
+    """Generate the embedding for a query, served from the query cache when seen before."""
+    return get_query_embeddings([text], output_dim)[0]
 
 
-def build_index(board_items: List[Dict[str, Any]], existing_index: Optional[pd.DataFrame] = None) -> Tuple[pd.DataFrame, Dict[str, int]]:
+def get_query_embeddings(queries: List[str], output_dim: int = EMBEDDING_DIM) -> List[Optional[List[float]]]:
+    """Embed queries in one batched request, skipping any already in the query cache."""
+    return query_cache.embed(EMBEDDING_MODEL, output_dim, queries, lambda texts: get_embeddings_batch(texts, output_dim))
+
+
+async def get_query_embeddings_async(queries: List[str], output_dim: int = EMBEDDING_DIM) -> List[Optional[List[float]]]:
+    """get_query_embeddings() on the async client."""
+    return await query_cache.aembed(EMBEDDING_MODEL, output_dim, queries, lambda texts: get_embeddings_batch_async(texts, output_dim))
+
+
+def build_index(
+    board_items: Iterable[Dict[str, Any]],
+    existing_index: Optional[Dict[str, Dict[str, Any]]] = None,
+    processed: Optional[Dict[str, Dict[str, Any]]] = None,
+    refresh: bool = False,
+) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, int]]:
     """
     Build searchable index from board items with strict synchronization.
     Items in 'existing_index' that are NOT in 'board_items' are discarded.
+    Returns the synced rows keyed by item id, in board order: unchanged items
+    keep their cached entry (with its matrix 'rows'), new / updated items carry
+    fresh 'text', 'item', 'chunks' and one vector per chunk in 'embeddings'.
+
+    'processed' is an optional per-index memo (id -> hash, chunks, fingerprint),
+    updated in place. Items that are the same object as last time, or whose
+    'updatedAt' fingerprint is unchanged, skip hashing and text extraction,
+    so a sync costs time proportional to the changed items.
+
+    'board_items' is consumed in a single pass, so it may be a generator
+    (e.g. canvas_ops.iter_board_items). With refresh=True the embedding
+    store is bypassed and every new / updated chunk is embedded again.
     """
-    
-    # 1. Create a quick lookup map from the Cache (if it exists)
-    # Map ID -> {Hash, DataRow}
-    cache_map = {}
-    if existing_index is not None and not existing_index.empty:
-        # Convert DataFrame to dictionary for O(1) access
-        # Assuming 'id' is unique
-        for _, row in existing_index.iterrows():
-            cache_map[row["id"]] = row.to_dict()
-
-    # 2. Identify Deletions for Stats
-    # Get IDs currently on the board
-    current_ids = set(item.get("id") for item in board_items if item.get("id"))
-    # Get IDs currently in the cache
-    cached_ids = set(cache_map.keys())
-    
-    # Calculate difference
-    ids_to_delete = cached_ids - current_ids
-    
+    cache_map = existing_index or {}
+    memo = processed if processed is not None else {}
+
     stats = {
-        "total_source": len(board_items),
+        "total_source": 0,
         "new": 0,
         "updated": 0,
         "unchanged": 0,
-        "deleted_from_cache": len(ids_to_delete)
+        "deleted_from_cache": 0
     }
 
-    print(f"Syncing Index: Found {len(ids_to_delete)} items to remove from cache.")
+    # Build the NEW index strictly from current board_items
+    new_index_rows = {}
+    pending = []
+    current_ids = set()
 
-    # 3. Build the NEW index strictly from current board_items
-    new_index_data = []
-    
     for item in board_items:
+        stats["total_source"] += 1
         item_id = item.get("id")
         
         # Skip items without ID
         if not item_id:
             continue
+        current_ids.add(item_id)
 
-        item_hash = compute_item_hash(item)
-        searchable_text = extract_searchable_text(item)
-        
-        if not searchable_text.strip():
+        seen = memo.get(item_id)
+        fingerprint = item_fingerprint(item)
+        if seen is not None and (seen["ref"] is item or (fingerprint is not None and seen["fingerprint"] == fingerprint)):
+            # Fast path: nothing to hash or extract
+            item_hash, extracted = seen["hash"], seen["extracted"]
+        else:
+            item_hash = compute_item_hash(item)
+            extracted = seen["extracted"] if seen is not None and seen["hash"] == item_hash else None
+        cached_item = cache_map.get(item_id)
+
+        # Reuse the cached row (embedding + metadata) when content is unchanged
+        if cached_item is not None and cached_item.get("hash") == item_hash:
+            stats["unchanged"] += 1
+            new_index_rows[item_id] = cached_item
+            memo[item_id] = {"ref": item, "fingerprint": fingerprint, "hash": item_hash, "extracted": extracted}
             continue
-        
-        # LOGIC: Check if we can reuse the cached embedding
-        if item_id in cache_map:
-            cached_item = cache_map[item_id]
-            
-            # Use 'get' for hash in case pickle structure changed slightly
-            if cached_item.get("hash") == item_hash:
-                # MATCH: Reuse entire row (embedding + metadata)
-                stats["unchanged"] += 1
-                new_index_data.append(cached_item)
-                continue
-            else:
-                # ID exists, but Content changed: Re-embed
-                stats["updated"] += 1
-                print(f"Updating content for: {item_id[:30]}...")
+
+        if extracted is None:
+            extracted = extract_chunks(item)
+        memo[item_id] = {"ref": item, "fingerprint": fingerprint, "hash": item_hash, "extracted": extracted}
+        searchable_text, chunks = extracted
+        if not chunks:
+            continue
+
+        if cached_item is not None:
+            # ID exists, but Content changed: Re-embed
+            stats["updated"] += 1
+            print(f"Updating content for: {item_id[:30]}...")
         else:
             # New ID: Create
             stats["new"] += 1
             print(f"Indexing new item: {item_id[:30]}...")
         
-        # If we are here, we need to generate an embedding (New or Updated)
-        embeddings = get_embeddings(searchable_text)
-        
-        if embeddings:
-            new_index_data.append({
-                "id": item_id,
-                "text": searchable_text,
-                "embeddings": embeddings,
-                "item": item,
-                "hash": item_hash
-            })
-    
-    # 4. Create the strictly synced DataFrame
-    # If board_items was empty, we return an empty DataFrame (cache is effectively wiped)
-    if not new_index_data:
-        return pd.DataFrame(columns=["id", "text", "embeddings", "item", "hash"]), stats
+        # Reserve the slot so board order is kept once the batch returns
+        new_index_rows[item_id] = None
+        pending.append({
+            "id": item_id,
+            "text": searchable_text,
+            "chunks": chunks,
+            "item": item,
+            "hash": item_hash
+        })
 
-    return pd.DataFrame(new_index_data), stats
+    # Identify Deletions for Stats
+    ids_to_delete = set(cache_map.keys()) - current_ids
+    stats["deleted_from_cache"] = len(ids_to_delete)
+    if ids_to_delete:
+        print(f"Syncing Index: Found {len(ids_to_delete)} items to remove from cache.")
+    for item_id in set(memo.keys()) - current_ids:
+        del memo[item_id]
 
+    # Embed all new / updated chunks in a few batched requests, reusing any
+    # text the content-addressed store has already seen
+    texts = [chunk for row in pending for chunk in row["chunks"]]
+    vectors = iter(embedding_store.embed(EMBEDDING_MODEL, EMBEDDING_DIM, texts, get_embeddings_batch, refresh=refresh))
+    for row in pending:
+        embeddings = [next(vectors) for _ in row["chunks"]]
+        if all(embeddings):
+            row["embeddings"] = embeddings
+            new_index_rows[row["id"]] = row
+        elif new_index_rows.get(row["id"]) is None:
+            # Ids are not guaranteed unique: keep a duplicate that did embed
+            new_index_rows.pop(row["id"], None)
 
-def search(query: str, index_df: pd.DataFrame, top_k: int = 5) -> List[Dict[str, Any]]:
-    """Search the index for relevant items."""
-    if index_df is None or index_df.empty:
-        return []
+    return new_index_rows, stats
 
-    # Get query embedding
-    query_embedding = get_embeddings(query)
-    if not query_embedding:
-        return []
-    
-    # Calculate cosine similarity
-    query_emb_array = np.array([query_embedding])
-    
-    # Ensure embeddings column is numpy array of lists
-    try:
-        index_embeddings = np.array(index_df["embeddings"].tolist())
-    except Exception as e:
-        print(f"Error processing embedding list: {e}")
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-/][a-z0-9]+)*")
+STOPWORDS = {
+    "a", "an", "and", "are", "at", "be", "by", "for", "from", "give", "in", "is", "it", "me",
+    "of", "on", "or", "show", "tell", "that", "the", "this", "to", "was", "what", "with",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms; keeps drug names, lab codes (ALT, HbA1c) and dates intact."""
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+
+class LexicalIndex:
+    """In-memory inverted index over item text with BM25 scoring."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.doc_terms: Dict[str, List[str]] = {}
+        self.doc_len: Dict[str, int] = {}
+        self.total_len = 0
+
+    def add(self, doc_id: str, text: str) -> None:
+        if doc_id in self.doc_len:
+            self.remove(doc_id)
+        terms = tokenize(text)
+        counts: Dict[str, int] = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        self.doc_terms[doc_id] = list(counts)
+        self.doc_len[doc_id] = len(terms)
+        self.total_len += len(terms)
+
+    def remove(self, doc_id: str) -> None:
+        length = self.doc_len.pop(doc_id, None)
+        if length is None:
+            return
+        self.total_len -= length
+        for term in self.doc_terms.pop(doc_id, []):
+            docs = self.postings.get(term, {})
+            docs.pop(doc_id, None)
+            if not docs:
+                self.postings.pop(term, None)
+
+    def search(self, query: str, top_k: int) -> Tuple[List[Tuple[str, float]], List[str]]:
+        """Return ([(doc_id, bm25)] best first, query terms)."""
+        terms = list(dict.fromkeys(tokenize(query)))
+        n = len(self.doc_len)
+        if not terms or n == 0:
+            return [], terms
+        avg_len = self.total_len / n or 1.0
+        scores: Dict[str, float] = {}
+        for term in terms:
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_id, tf in docs.items():
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return heapq.nlargest(top_k, scores.items(), key=lambda kv: kv[1]), terms
+
+    def matches_all(self, doc_id: str, terms: List[str]) -> bool:
+        return all(doc_id in self.postings.get(term, {}) for term in terms)
+
+    def copy(self) -> "LexicalIndex":
+        """Independent copy to update for a new index version."""
+        clone = LexicalIndex(self.k1, self.b)
+        clone.postings = {term: dict(docs) for term, docs in self.postings.items()}
+        clone.doc_terms = dict(self.doc_terms)
+        clone.doc_len = dict(self.doc_len)
+        clone.total_len = self.total_len
+        return clone
+
+
+_legacy_migrated = False
+
+
+def _migrate_legacy_once() -> None:
+    global _legacy_migrated
+    if not _legacy_migrated:
+        _legacy_migrated = True
+        migrate_legacy_index()
+        if os.path.exists(LEGACY_OBJECT_CACHE_PATH):
+            # Another model and whole-object text: none of it can match a chunk's store key
+            print(f"{LEGACY_OBJECT_CACHE_PATH} is no longer used (its vectors are from another model) and can be deleted")
+
+
+def partition_dir(patient_id: str, root: str = INDEX_DIR) -> str:
+    """Index directory of a patient's partition."""
+    safe_id = re.sub(r"[^a-z0-9_-]", "_", str(patient_id).lower())
+    return os.path.join(root, safe_id)
+
+
+class IndexVersion:
+    """
+    One version of a partition: sidecar, vectors, item map, BM25 index and
+    optional quantized / IVF data. A version is never modified once opened;
+    syncs build a new one and swap it in with a single assignment, and each
+    search takes one version up front, so row numbers, records and lexical
+    hits always come from the same version. The items file is memory-mapped
+    when the version opens, so records stay readable after a newer version
+    has removed the file.
+    """
+
+    def __init__(self, index_dir: str, meta: Dict[str, Any], matrix: Optional[np.ndarray]):
+        self.index_dir = index_dir
+        self.meta = meta
+        self.matrix = matrix if matrix is not None and len(matrix) else None
+        # Optional compressed first-pass copy of the matrix (RAG_VECTOR_DTYPE)
+        self.qmatrix: Optional[np.ndarray] = None
+        self.scales: Optional[np.ndarray] = None
+        quantized = meta.get("quantized")
+        if self.matrix is not None and quantized and quantized["dtype"] == RAG_VECTOR_DTYPE:
+            # Loaded into RAM: the compressed copy is what stays resident
+            self.qmatrix = np.load(_index_file(index_dir, quantized["vectors"]))
+            if "scales" in quantized:
+                self.scales = np.load(_index_file(index_dir, quantized["scales"]))
+        # Optional IVF ANN index (RAG_ANN_BACKEND=ivf)
+        self.ivf: Optional[IVFIndex] = None
+        ivf = meta.get("ivf")
+        if self.matrix is not None and ivf and RAG_ANN_BACKEND == "ivf":
+            self.ivf = IVFIndex(
+                np.load(_index_file(index_dir, ivf["centroids"])),
+                np.load(_index_file(index_dir, ivf["assign"])),
+                ivf["trained_rows"],
+            )
+        self.records: Optional[mmap.mmap] = None
+        if self.matrix is not None:
+            with open(_index_file(index_dir, meta["items"]), "rb") as f:
+                self.records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        for row, (item_id, item_hash) in enumerate(zip(meta.get("ids", []), meta.get("hashes", []))):
+            entry = self.entries.setdefault(item_id, {"id": item_id, "hash": item_hash, "rows": []})
+            entry["rows"].append(row)
+        # BM25 index over item text: carried over by sync or built on first use
+        self.lexical: Optional[LexicalIndex] = None
+        self._lexical_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def version(self) -> int:
+        return self.meta.get("version", 0)
+
+    @property
+    def ids(self) -> List[str]:
+        return self.meta.get("ids", [])
+
+    def snapshot(self) -> "IndexVersion":
+        return self
+
+    def memory_bytes(self) -> int:
+        """Approximate resident size of the version (vectors + sidecar)."""
+        if self.qmatrix is not None:
+            matrix_bytes = self.qmatrix.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+        else:
+            matrix_bytes = self.matrix.nbytes if self.matrix is not None else 0
+        return matrix_bytes + 200 * len(self.entries)
+
+    def read_record_bytes(self, row: int) -> bytes:
+        """Raw JSONL record (id, text, item) for a matrix row."""
+        offset = self.meta["offsets"][row]
+        return self.records[offset:offset + self.meta["lengths"][row]]
+
+    def read_record(self, row: int) -> Dict[str, Any]:
+        return json.loads(self.read_record_bytes(row))
+
+    def get_lexical(self) -> LexicalIndex:
+        """BM25 index over the item texts, built from the items file on first use."""
+        if self.lexical is None:
+            with self._lexical_lock:
+                if self.lexical is None:
+                    lexical = LexicalIndex()
+                    for entry in self.entries.values():
+                        lexical.add(entry["id"], self.read_record(entry["rows"][0])["text"])
+                    self.lexical = lexical
+        return self.lexical
+
+    def chunk_of(self, row: int) -> int:
+        """Chunk number of a matrix row within its item."""
+        return self.meta["chunks"][row]
+
+
+class RagIndex:
+    """
+    Process-resident RAG index for one patient's board.
+    Opens the memory-mapped vector store once and only re-embeds / persists
+    when a sync actually changes something. Item records are read lazily
+    from the items file, so only search hits are ever deserialized.
+    The searchable state lives in 'current' (an IndexVersion), replaced as a
+    whole on every change.
+    """
+
+    def __init__(self, patient_id: str, index_dir: Optional[str] = None, sync_interval: float = RAG_SYNC_INTERVAL):
+        self.patient_id = patient_id
+        self.index_dir = index_dir or partition_dir(patient_id)
+        self.sync_interval = sync_interval
+        self.current = IndexVersion(self.index_dir, {}, None)
+        # In-memory memo of per-item hash / extracted text (see build_index)
+        self.processed: Dict[str, Dict[str, Any]] = {}
+        self.last_sync = 0.0
+        # Bumped by mark_stale(); a sync that started before the bump does not count as fresh
+        self.stale_marks = 0
+        self.loaded = False
+        # Short lock for opening / swapping versions; searches take neither lock
+        self._lock = threading.RLock()
+        # One sync at a time; held through embedding, so only other syncs wait on it
+        self._sync_lock = threading.Lock()
+        # Bounded result cache; entries of older versions can never hit again
+        self.results: "OrderedDict[Tuple[str, int, int], List[Dict[str, Any]]]" = OrderedDict()
+        self._results_lock = threading.Lock()
+        self.result_hits = 0
+        self.result_misses = 0
+
+    def __len__(self) -> int:
+        return len(self.current)
+
+    def snapshot(self) -> IndexVersion:
+        """The current version; searches hold on to it for their whole run."""
+        return self.current
+
+    def memory_bytes(self) -> int:
+        """Approximate resident size of the partition (vectors + sidecar)."""
+        return self.current.memory_bytes()
+
+    @property
+    def meta(self) -> Dict[str, Any]:
+        return self.current.meta
+
+    @property
+    def matrix(self) -> Optional[np.ndarray]:
+        return self.current.matrix
+
+    @property
+    def entries(self) -> Dict[str, Dict[str, Any]]:
+        return self.current.entries
+
+    @property
+    def ids(self) -> List[str]:
+        return self.current.ids
+
+    def load(self) -> "RagIndex":
+        """Open the persisted index once (migrating the legacy pickle if needed)."""
+        if self.loaded:
+            return self
+        with self._lock:
+            if not self.loaded:
+                loaded = load_index(self.index_dir)
+                if loaded is None:
+                    _migrate_legacy_once()
+                self._open(*(loaded or ({}, None)))
+                self.loaded = True
+                print(f"Loaded cache with {len(self)} items.")
+        return self
+
+    @property
+    def version(self) -> int:
+        """Index version; only bumps when a sync actually changes the index."""
+        return self.current.version
+
+    def _open(self, meta: Dict[str, Any], matrix: Optional[np.ndarray]) -> None:
+        self._swap(IndexVersion(self.index_dir, meta, matrix))
+
+    def _swap(self, version: IndexVersion) -> None:
+        """Make 'version' the one new searches see (searches in flight keep theirs)."""
+        with self._lock:
+            if version.version != self.current.version or not version.meta:
+                with self._results_lock:
+                    self.results.clear()
+            self.current = version
+
+    def _reload_if_changed(self) -> None:
+        """Pick up an index version written by another worker."""
+        try:
+            with open(_index_file(self.index_dir, META_FILE), "r", encoding="utf-8") as f:
+                version = json.load(f).get("version")
+        except (OSError, ValueError):
+            return
+        if version != self.current.version:
+            latest = self._open_latest()
+            if latest is not None:
+                self._swap(latest)
+
+    def _open_latest(self, attempts: int = 3) -> Optional[IndexVersion]:
+        """
+        Open the newest on-disk version. Another worker can replace meta.json
+        and remove older files between reading the sidecar and opening them,
+        so a missing file means "read the sidecar again". Returns None (keep
+        serving the current version) if that keeps failing.
+        """
+        for _ in range(attempts):
+            loaded = load_index(self.index_dir)
+            if loaded is None:
+                continue
+            try:
+                return IndexVersion(self.index_dir, *loaded)
+            except FileNotFoundError:
+                continue
+        print(f"Could not open the latest index of {self.patient_id}, keeping v{self.current.version}")
+        return None
+
+    def read_record(self, row: int) -> Dict[str, Any]:
+        return self.current.read_record(row)
+
+    def get_lexical(self) -> LexicalIndex:
+        return self.current.get_lexical()
+
+    def is_stale(self) -> bool:
+        """True if the index was never synced or the sync interval elapsed."""
+        return self.last_sync == 0.0 or time.time() - self.last_sync > self.sync_interval
+
+    def mark_stale(self) -> None:
+        """Make the next query sync first (e.g. after this process edited the board)."""
+        self.stale_marks += 1
+        self.last_sync = 0.0
+
+    def _needs_inline_sync(self) -> bool:
+        """
+        Stale and nobody else is syncing. If a sync (e.g. the board watcher's)
+        is already running, queries use the current version instead of
+        waiting for it, unless there is nothing to search yet.
+        """
+        return self.is_stale() and (len(self) == 0 or not self._sync_lock.locked())
+
+    def sync(
+        self,
+        board_items: Optional[Iterable[Dict[str, Any]]] = None,
+        data_path: str = "output/board_items.json",
+        rebuild: bool = False,
+    ) -> Dict[str, int]:
+        """
+        Sync the index with this patient's board; only changed items are
+        re-embedded and persisted. The new version is built without holding
+        the partition lock, which is only taken to swap it in.
+        rebuild=True ignores the persisted version (rows, BM25 and IVF state)
+        and re-embeds every item.
+        """
+        with self._sync_lock:
+            marks = self.stale_marks
+            self.load()
+            if rebuild:
+                # Start from an empty version; only its number is kept so versions stay monotonic
+                current = IndexVersion(self.index_dir, {"version": self.current.version}, None)
+                self.processed.clear()
+            else:
+                self._reload_if_changed()
+                current = self.current
+            if board_items is None:
+                board_items = load_board_items(data_path, self.patient_id)
+
+            rows, stats = build_index(board_items, current.entries, self.processed, refresh=rebuild)
+            changed = rebuild or stats["new"] or stats["updated"] or len(rows) != len(current.entries)
+            if changed:
+                meta = save_index(list(rows.values()), self.index_dir, source=current)
+                version = IndexVersion(self.index_dir, meta, np.load(_index_file(self.index_dir, meta["vectors"]), mmap_mode="r"))
+                # Carry the BM25 index over (a copy, searches may be using the old one)
+                if current.lexical is not None:
+                    lexical = current.lexical.copy()
+                    for item_id in set(lexical.doc_len) - set(rows):
+                        lexical.remove(item_id)
+                    for row in rows.values():
+                        if "embeddings" in row:
+                            lexical.add(row["id"], row["text"])
+                    version.lexical = lexical
+                self._swap(version)
+
+            # The board may have been edited while this sync was reading it
+            self.last_sync = time.time() if self.stale_marks == marks else 0.0
+            print(f"Index Sync [{self.patient_id}]: new={stats['new']} updated={stats['updated']} "
+                  f"unchanged={stats['unchanged']} deleted={stats['deleted_from_cache']} active={len(self)}")
+            return stats
+
+    def sync_if_idle(self, board_items: Optional[Iterable[Dict[str, Any]]] = None, data_path: str = "output/board_items.json") -> Optional[Dict[str, int]]:
+        """
+        sync() unless another sync is already running (returns None then), for
+        callers that would rather search the current version than wait behind
+        someone else's embedding batch. An empty index always waits.
+        """
+        if len(self) and self._sync_lock.locked():
+            return None
+        return self.sync(board_items, data_path)
+
+    def query(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
+        """Search the resident index, syncing first only when it is stale."""
+        return self.query_many([query], top_k=top_k)[0]
+
+    def query_many(self, queries: List[str], top_k: int = 5) -> List[List[Dict[str, Any]]]:
+        """
+        Batched query(): one embedding request and one scoring pass for all
+        queries. Results for a (normalized query, top_k) already answered at
+        the current index version come from the result cache.
+        """
+        if self._needs_inline_sync():
+            self.sync()
+        version = self.current
+        keys, results, pending = self._cached_results(queries, top_k, version.version)
+        if pending:
+            self._cache_results(keys, results, pending, *_search_many([queries[i] for i in pending], version, top_k, None))
+        # Callers may decorate results, so hand out copies
+        return [[dict(r) for r in result] for result in results]
+
+    async def sync_async(self, board_items: Optional[List[Dict[str, Any]]] = None, data_path: str = "output/board_items.json") -> Dict[str, int]:
+        """sync() without blocking the event loop: async board fetch, embedding and persistence on a worker thread."""
+        if board_items is None:
+            board_items = await load_board_items_async(data_path, self.patient_id)
+        return await asyncio.to_thread(self.sync, board_items, data_path)
+
+    async def query_async(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
+        return (await self.query_many_async([query], top_k=top_k))[0]
+
+    async def query_many_async(self, queries: List[str], top_k: int = 5) -> List[List[Dict[str, Any]]]:
+        """query_many() for the event loop."""
+        if self._needs_inline_sync():
+            await self.sync_async()
+        version = self.current
+        keys, results, pending = self._cached_results(queries, top_k, version.version)
+        if pending:
+            self._cache_results(keys, results, pending, *(await _search_many_async([queries[i] for i in pending], version, top_k, None)))
+        return [[dict(r) for r in result] for result in results]
+
+    def _cached_results(self, queries: List[str], top_k: int, version: int):
+        """(cache keys, cached result or None per query, indices still to search)."""
+        # Results are cached under the version they were computed against
+        keys = [(normalize_query(q), top_k, version) for q in queries]
+        results: List[Optional[List[Dict[str, Any]]]] = []
+        # Cheap enough to take on the event loop: no sync ever holds it
+        with self._results_lock:
+            for key in keys:
+                cached = self.results.get(key)
+                if cached is not None:
+                    self.results.move_to_end(key)
+                results.append(cached)
+        pending = [i for i, r in enumerate(results) if r is None]
+        self.result_hits += len(queries) - len(pending)
+        self.result_misses += len(pending)
+        return keys, results, pending
+
+    def _cache_results(
+        self, keys: List[Tuple[str, int, int]], results: List[Any], pending: List[int], fresh: List[List[Dict[str, Any]]], degraded: set
+    ) -> None:
+        """Fill in fresh results; those computed without a query embedding are not cached."""
+        with self._results_lock:
+            for n, (i, result) in enumerate(zip(pending, fresh)):
+                results[i] = result
+                if n not in degraded:
+                    self.results[keys[i]] = result
+            while len(self.results) > RAG_RESULT_CACHE_SIZE:
+                self.results.popitem(last=False)
+
+
+def _dense_rows_many(index: IndexVersion, query_matrix: np.ndarray, candidates: int) -> List[List[Tuple[float, int]]]:
+    """
+    Top (similarity, row) pairs per query (one row of 'query_matrix' each),
+    best first, streamed block by block over the matrix so every block is
+    scored against all queries with one matrix-matrix product.
+    With an IVF index only the rows of the RAG_IVF_NPROBE nearest lists are
+    scored. With a quantized copy, the first pass runs on the compressed
+    vectors and RAG_RERANK_FACTOR x candidates are re-scored at full precision.
+    """
+    if index.ivf is not None:
+        return [_ivf_rows(index, query_vec, candidates) for query_vec in query_matrix]
+    if index.qmatrix is not None:
+        first_pass = min(len(index.qmatrix), candidates * RAG_RERANK_FACTOR)
+        results = []
+        for query_vec, first in zip(query_matrix, _top_rows_many(index.qmatrix, query_matrix, first_pass, index.scales)):
+            rows = sorted(row for _, row in first)
+            exact = np.asarray(index.matrix[rows]) @ query_vec
+            results.append(sorted(zip(exact.tolist(), rows), reverse=True)[:candidates])
+        return results
+    return _top_rows_many(index.matrix, query_matrix, candidates)
+
+
+def _ivf_rows(index: IndexVersion, query_vec: np.ndarray, candidates: int) -> List[Tuple[float, int]]:
+    """Score only the rows in the nprobe closest inverted lists."""
+    rows = index.ivf.candidates(query_vec, RAG_IVF_NPROBE)
+    if len(rows) == 0:
         return []
-    
-    similarities = cosine_similarity(query_emb_array, index_embeddings)[0]
-    
-    # Get top k results
+    similarities = np.asarray(index.matrix[rows]) @ query_vec
+    top = np.argpartition(similarities, -min(candidates, len(rows)))[-min(candidates, len(rows)):]
+    return sorted(((float(similarities[t]), int(rows[t])) for t in top), reverse=True)
+
+
+def _top_rows(matrix: np.ndarray, query_vec: np.ndarray, candidates: int, scales: Optional[np.ndarray] = None) -> List[Tuple[float, int]]:
+    return _top_rows_many(matrix, query_vec[None, :], candidates, scales)[0]
+
+
+def _top_rows_many(matrix: np.ndarray, query_matrix: np.ndarray, candidates: int, scales: Optional[np.ndarray] = None) -> List[List[Tuple[float, int]]]:
+    query_matrix = np.asarray(query_matrix, dtype=np.float32)
+    heaps: List[List[Tuple[float, int]]] = [[] for _ in range(len(query_matrix))]
+    for start in range(0, len(matrix), SEARCH_BLOCK_ROWS):
+        block = matrix[start:start + SEARCH_BLOCK_ROWS]
+        if block.dtype == np.float32:
+            similarities = block @ query_matrix.T
+        else:
+            similarities = quantized_scores(block, scales[start:start + len(block)] if scales is not None else None, query_matrix.T)
+        block_k = min(candidates, len(similarities))
+        for q, heap in enumerate(heaps):
+            column = similarities[:, q]
+            for idx in np.argpartition(column, -block_k)[-block_k:]:
+                candidate = (float(column[idx]), start + int(idx))
+                if len(heap) < candidates:
+                    heapq.heappush(heap, candidate)
+                elif candidate > heap[0]:
+                    heapq.heapreplace(heap, candidate)
+    return [sorted(heap, reverse=True) for heap in heaps]
+
+
+def _make_result(index: IndexVersion, row: int, similarity: float, chunk_rows: List[int]) -> Dict[str, Any]:
+    record = index.read_record(row)
+    result = {
+        "id": record["id"],
+        "text": record["text"],
+        "similarity": similarity,
+        "item": record["item"]
+    }
+    if "chunks" in record and chunk_rows:
+        result["chunks"] = [record["chunks"][c] for c in sorted(index.chunk_of(r) for r in chunk_rows)]
+    return result
+
+
+def _lexical_fast_path(index: IndexVersion, query: str, top_k: int) -> Optional[List[Dict[str, Any]]]:
+    """
+    Answer from BM25 alone when the query is a few exact terms (drug names,
+    "ALT", dates) and one item clearly wins, skipping the embedding round trip.
+    """
+    lexical = index.get_lexical()
+    hits, terms = lexical.search(query, top_k + 1)
+    if not hits or not terms or len(terms) > RAG_LEXICAL_MAX_TERMS:
+        return None
+    best_id, best = hits[0]
+    runner_up = hits[1][1] if len(hits) > 1 else 0.0
+    if not lexical.matches_all(best_id, terms) or best < RAG_LEXICAL_MARGIN * runner_up:
+        return None
+    print(f"Lexical fast path for: {query}")
+    return _lexical_results(index, hits[:top_k])
+
+
+def _lexical_results(index: IndexVersion, hits: List[Tuple[str, float]]) -> List[Dict[str, Any]]:
+    """Results for BM25 hits alone, scored relative to the best hit."""
+    best = (hits[0][1] or 1.0) if hits else 1.0
+    results = []
+    for item_id, score in hits:
+        result = _make_result(index, index.entries[item_id]["rows"][0], score / best, [])
+        result["match"] = "lexical"
+        results.append(result)
+    return results
+
+
+def search(query: str, index: RagIndex, top_k: int = 5, mode: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Search the index for relevant items.
+    Stored vectors are unit length, so cosine similarity is one dot product
+    per block of the memory-mapped matrix; each block's top candidates are
+    picked with argpartition and merged into a bounded heap. Chunk scores are
+    aggregated per item (best chunk wins) and, in 'field' chunk mode, each
+    result also lists the matched 'chunks'.
+
+    In 'hybrid' mode BM25 candidates are merged in and ranked by
+    (1 - RAG_LEXICAL_WEIGHT) * cosine + RAG_LEXICAL_WEIGHT * normalized BM25,
+    and confident exact-term queries are answered lexically without an
+    embedding call.
+    """
+    return search_many([query], index, top_k=top_k, mode=mode)[0]
+
+
+def search_many(queries: List[str], index: RagIndex, top_k: int = 5, mode: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+    """
+    Search the index for several queries at once (see search()). Queries not
+    answered by the lexical fast path are embedded in one batched request and
+    scored against the matrix together, so N queries cost one round trip and
+    one pass over the vectors. Returns one ranked result list per query.
+    """
+    return _search_many(queries, index, top_k, mode)[0]
+
+
+def _search_many(queries: List[str], index: RagIndex, top_k: int, mode: Optional[str]) -> Tuple[List[List[Dict[str, Any]]], set]:
+    """search_many() plus the indices of queries whose results must not be cached."""
+    index = index.snapshot()
+    plan = _plan_search(queries, index, top_k, mode)
+    if not plan["pending"]:
+        return plan["results"], plan["degraded"]
+    # Get query embeddings in one batched request (repeat queries are cached)
+    embeddings = get_query_embeddings([queries[i] for i in plan["pending"]])
+    return _score_search(index, plan, embeddings), plan["degraded"]
+
+
+async def search_many_async(queries: List[str], index: RagIndex, top_k: int = 5, mode: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+    """search_many() for the event loop: async embedding, index reads on a worker thread."""
+    return (await _search_many_async(queries, index, top_k, mode))[0]
+
+
+async def _search_many_async(queries: List[str], index: RagIndex, top_k: int, mode: Optional[str]) -> Tuple[List[List[Dict[str, Any]]], set]:
+    index = index.snapshot()
+    plan = await asyncio.to_thread(_plan_search, queries, index, top_k, mode)
+    if not plan["pending"]:
+        return plan["results"], plan["degraded"]
+    embeddings = await get_query_embeddings_async([queries[i] for i in plan["pending"]])
+    return await asyncio.to_thread(_score_search, index, plan, embeddings), plan["degraded"]
+
+
+def _plan_search(queries: List[str], index: IndexVersion, top_k: int, mode: Optional[str]) -> Dict[str, Any]:
+    """Answer what BM25 alone can; the rest ('pending') need a query embedding."""
+    mode = mode or RAG_SEARCH_MODE
+    # 'degraded': queries answered without their embedding (never cached)
+    plan: Dict[str, Any] = {"results": [[] for _ in queries], "pending": [], "lexical_hits": {}, "actual_k": 0, "degraded": set()}
+    if index is None or index.matrix is None or len(index) == 0:
+        return plan
+
     # Ensure we don't ask for more items than exist
-    actual_k = min(top_k, len(index_df))
+    actual_k = plan["actual_k"] = min(top_k, len(index))
     if actual_k == 0:
-        return []
+        return plan
+
+    for i, query in enumerate(queries):
+        if mode == "hybrid":
+            fast = _lexical_fast_path(index, query, actual_k)
+            if fast is not None:
+                plan["results"][i] = fast
+                continue
+            plan["lexical_hits"][i], _ = index.get_lexical().search(query, actual_k * 2)
+        plan["pending"].append(i)
+    return plan
+
+
+def _score_search(index: IndexVersion, plan: Dict[str, Any], embeddings: List[Optional[List[float]]]) -> List[List[Dict[str, Any]]]:
+    """Score the pending queries' embeddings against the matrix in one pass."""
+    results, lexical_hits, actual_k = plan["results"], plan["lexical_hits"], plan["actual_k"]
+    embedded = [(i, normalize_vector(v)) for i, v in zip(plan["pending"], embeddings) if v]
+    for i, vector in zip(plan["pending"], embeddings):
+        if not vector:
+            # Embedding failed (rate limit, network): fall back to BM25 and retry next time
+            plan["degraded"].add(i)
+            results[i] = _lexical_results(index, lexical_hits.get(i, [])[:actual_k])
+    if not embedded:
+        return results
+
+    # Several chunks of one item can outrank other items, so over-fetch rows
+    pools = {i: min(len(index), actual_k * 2) if lexical_hits.get(i) else actual_k for i, _ in embedded}
+    pool = max(pools.values())
+    candidates = pool if len(index.matrix) == len(index) else min(len(index.matrix), pool * RAG_CHUNK_CANDIDATES)
+    query_matrix = np.array([v for _, v in embedded], dtype=np.float32)
+    for (i, query_vec), rows in zip(embedded, _dense_rows_many(index, query_matrix, candidates)):
+        results[i] = _rank(index, query_vec, rows, pools[i], lexical_hits.get(i, []), actual_k)
+    return results
+
+def _rank(
+    index: IndexVersion,
+    query_vec: np.ndarray,
+    dense_rows: List[Tuple[float, int]],
+    pool: int,
+    lexical_hits: List[Tuple[str, float]],
+    actual_k: int,
+) -> List[Dict[str, Any]]:
+    """Aggregate one query's dense rows per item and fuse in its BM25 hits."""
+    # Aggregate chunk hits per item, keeping the best score
+    hits: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    for similarity, row in dense_rows:
+        item_id = index.ids[row]
+        if item_id not in hits:
+            if len(hits) == pool:
+                continue
+            hits[item_id] = {"similarity": similarity, "row": row, "chunk_rows": []}
+        hits[item_id]["chunk_rows"].append(row)
+
+    if not lexical_hits:
+        return [_make_result(index, h["row"], h["similarity"], h["chunk_rows"]) for h in list(hits.values())[:actual_k]]
+
+    # Score lexical-only candidates densely too, then fuse
+    for item_id, _ in lexical_hits:
+        if item_id not in hits and item_id in index.entries:
+            rows = index.entries[item_id]["rows"]
+            similarities = index.matrix[rows] @ query_vec
+            best = int(np.argmax(similarities))
+            hits[item_id] = {"similarity": float(similarities[best]), "row": rows[best], "chunk_rows": [rows[best]]}
+    top_bm25 = lexical_hits[0][1] or 1.0
+    bm25 = {item_id: score / top_bm25 for item_id, score in lexical_hits}
+    for item_id, hit in hits.items():
+        hit["score"] = (1 - RAG_LEXICAL_WEIGHT) * hit["similarity"] + RAG_LEXICAL_WEIGHT * bm25.get(item_id, 0.0)
+    ranked = sorted(hits.values(), key=lambda h: h["score"], reverse=True)[:actual_k]
 
-    top_indices = np.argsort(similarities)[-actual_k:][::-1]
-    
     results = []
-    for idx in top_indices:
-        results.append({
-            "id": index_df.iloc[idx]["id"],
-            "text": index_df.iloc[idx]["text"],
-            "similarity": float(similarities[idx]),
-            "item": index_df.iloc[idx]["item"]
-        })
-    
+    for hit in ranked:
+        result = _make_result(index, hit["row"], hit["similarity"], hit["chunk_rows"])
+        result["score"] = hit["score"]
+        results.append(result)
     return results
 
 
-def initialize_rag(data_path: str = "output/board_items.json", force_rebuild: bool = False) -> pd.DataFrame:
-    """Initialize RAG system by syncing logic."""
-    
-    board_items = load_board_items(data_path)
-    
-    # Try to load existing index
-    existing_index = None if force_rebuild else load_index()
-    
-    if existing_index is not None:
-        print(f"Loaded cache with {len(existing_index)} items.")
-    
-    # Build/Sync Index
-    index_df, stats = build_index(board_items, existing_index)
-    
-    print(f"\nIndex Sync Statistics:")
-    print(f"  Deleted (Removed from cache): {stats['deleted_from_cache']}")
-    print(f"  New (Embedded): {stats['new']}")
-    print(f"  Updated (Re-embedded): {stats['updated']}")
-    print(f"  Unchanged (Reused): {stats['unchanged']}")
-    print(f"  Total Active Items: {len(index_df)}")
-    
-    # Save the strictly synced index
-    save_index(index_df)
-    
-    return index_df
+def _compact_item(value: Any, drop: set) -> Any:
+    """Item without UI / private / empty fields (and the 'drop' keys at any depth)."""
+    if isinstance(value, dict):
+        compact = {}
+        for key, v in value.items():
+            if key in UI_KEYS or key in drop or key.startswith('_'):
+                continue
+            v = _compact_item(v, drop)
+            if v not in (None, "", [], {}):
+                compact[key] = v
+        return compact
+    if isinstance(value, list):
+        return [_compact_item(v, drop) for v in value]
+    return value
+
+
+def build_context(results: List[Dict[str, Any]], max_tokens: Optional[int] = None) -> Tuple[str, int]:
+    """
+    Render ranked search results as compact prompt context within a token
+    budget. Each item appears once, as one line of compact JSON without its
+    UI fields or the duplicated 'text'. When everything does not fit,
+    CONTEXT_LOW_VALUE_KEYS are dropped from every item first; then items are
+    kept in rank order, the last one cut down to its matched chunks (or
+    truncated) and lower-ranked ones left out. Returns (context, tokens used).
+    """
+    budget = max_tokens or RAG_CONTEXT_TOKENS
+    seen, unique = set(), []
+    for result in results:
+        item = result.get("item") or {}
+        key = result.get("id") or json.dumps(item, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            unique.append(result)
+
+    def render(drop: set) -> List[str]:
+        return [json.dumps(_compact_item(r.get("item") or {}, drop), ensure_ascii=False, separators=(",", ":")) for r in unique]
+
+    lines = render(set())
+    if count_tokens("\n".join(lines)) > budget:
+        lines = render(CONTEXT_LOW_VALUE_KEYS)
 
+    kept: List[str] = []
+    used = 0
+    for result, line in zip(unique, lines):
+        cost = count_tokens(line) + 1
+        if used + cost <= budget:
+            kept.append(line)
+            used += cost
+            continue
+        # Partial fit: identifying fields plus matched chunks, else a truncated line
+        remaining = (budget - used) * 3
+        item = result.get("item") or {}
+        if result.get("chunks"):
+            header = {k: item[k] for k in CHUNK_HEADER_KEYS if k in item}
+            header["matched"] = result["chunks"]
+            line = json.dumps(header, ensure_ascii=False, separators=(",", ":"))
+        if len(line) > remaining:
+            line = line[:max(0, remaining - 16)] + "...(truncated)"
+        if remaining > 200:
+            kept.append(line)
+        break
+
+    context = "\n".join(kept)
+    tokens = count_tokens(context) if context else 0
+    print(f"Context: {len(kept)}/{len(results)} items, ~{tokens} tokens (budget {budget})")
+    return context, tokens
+
+
+class PartitionedRagIndex:
+    """
+    Per-patient RAG index partitions with an LRU cap on resident memory.
+    Switching patients keeps every partition on disk, so coming back to a
+    patient only re-embeds what changed on their board.
+    """
+
+    def __init__(self, root: str = INDEX_DIR, max_memory_bytes: int = RAG_PARTITION_MEMORY_MB * 1024 * 1024):
+        self.root = root
+        self.max_memory_bytes = max_memory_bytes
+        self.partitions: "OrderedDict[str, RagIndex]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, patient_id: Optional[str] = None) -> RagIndex:
+        """Return the (loaded) partition for a patient, defaulting to the current one."""
+        patient_id = (patient_id or patient_manager.get_patient_id()).lower()
+        with self._lock:
+            partition = self.partitions.get(patient_id)
+            if partition is None:
+                partition = RagIndex(patient_id, partition_dir(patient_id, self.root))
+                self.partitions[patient_id] = partition
+            self.partitions.move_to_end(patient_id)
+            partition.load()
+            self._evict(keep=patient_id)
+            return partition
+
+    def _evict(self, keep: str) -> None:
+        """Drop least recently used partitions until resident memory fits the cap."""
+        total = sum(p.memory_bytes() for p in self.partitions.values())
+        for patient_id in list(self.partitions.keys()):
+            if total <= self.max_memory_bytes:
+                break
+            if patient_id == keep:
+                continue
+            total -= self.partitions.pop(patient_id).memory_bytes()
+            print(f"Evicted RAG partition for {patient_id}")
 
-def query_rag(query: str, index_df: pd.DataFrame, top_k: int = 3, return_raw: bool = False):
+    def load(self) -> RagIndex:
+        return self.get()
+
+    def sync(self, board_items: Optional[Iterable[Dict[str, Any]]] = None, data_path: str = "output/board_items.json") -> Dict[str, int]:
+        stats = self.get().sync(board_items, data_path)
+        with self._lock:
+            self._evict(keep=patient_manager.get_patient_id().lower())
+        return stats
+
+    def query(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
+        return self.get().query(query, top_k=top_k)
+
+    def query_many(self, queries: List[str], top_k: int = 5) -> List[List[Dict[str, Any]]]:
+        return self.get().query_many(queries, top_k=top_k)
+
+    async def query_many_async(self, queries: List[str], top_k: int = 5) -> List[List[Dict[str, Any]]]:
+        # Opening a partition reads its sidecar and maps the vector file
+        index = await asyncio.to_thread(self.get)
+        return await index.query_many_async(queries, top_k=top_k)
+
+    def mark_stale(self, patient_id: Optional[str] = None) -> None:
+        """Mark a resident partition stale; partitions on disk sync when they are next opened anyway."""
+        patient_id = (patient_id or patient_manager.get_patient_id()).lower()
+        with self._lock:
+            partition = self.partitions.get(patient_id)
+        if partition is not None:
+            partition.mark_stale()
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-partition index version and result cache counters."""
+        with self._lock:
+            return {
+                patient_id: {
+                    "version": p.version,
+                    "items": len(p),
+                    "result_hits": p.result_hits,
+                    "result_misses": p.result_misses,
+                    "cached_results": len(p.results),
+                }
+                for patient_id, p in self.partitions.items()
+            }
+
+
+# Long-lived index owned by the process (loaded at server startup)
+rag_index = PartitionedRagIndex()
+# Edits made by this process (canvas_ops, side_agent) reach retrieval without waiting out RAG_SYNC_INTERVAL
+board_cache.on_invalidate(rag_index.mark_stale)
+
+
+def initialize_rag(data_path: str = "output/board_items.json", force_rebuild: bool = False) -> RagIndex:
+    """Load the current patient's partition and sync it with the board."""
+    index = rag_index.get()
+    index.sync(data_path=data_path, rebuild=force_rebuild)
+    return index
+
+
+def query_rag(query: str, index: RagIndex, top_k: int = 3, return_raw: bool = False):
     """Query the RAG system."""
-    if index_df.empty:
+    if len(index) == 0:
         print("Warning: RAG Index is empty.")
         return [] if return_raw else "No data available."
 
     print(f"Searching for: {query}")
-    results = search(query, index_df, top_k=top_k)
+    results = search(query, index, top_k=top_k)
     
     if return_raw:
         return results
@@ -307,13 +1700,31 @@ def query_rag(query: str, index_df: pd.DataFrame, top_k: int = 3, return_raw: bo
 def run_rag(query, top_k=3):
    """Entry point helper."""
    print(f"RAG system running for query: {query}")
-   # In a real app, you might want to load index once globally, 
-   # but here we initialize to ensure sync
-   index = initialize_rag() 
-   results = query_rag(query, index, top_k=top_k, return_raw=True)
+   results = rag_index.query(query, top_k=top_k)
+   print(f"RAG system returned {len(results)} results.")
+   return results
+
+def run_rag_many(queries, top_k=3):
+   """Entry point helper for several queries (sub-questions, rephrasings) at once."""
+   print(f"RAG system running for {len(queries)} queries")
+   results = rag_index.query_many(list(queries), top_k=top_k)
+   print(f"RAG system returned {sum(len(r) for r in results)} results.")
+   return results
+
+async def run_rag_async(query, top_k=3):
+   """run_rag() for async callers; never blocks the event loop."""
+   print(f"RAG system running for query: {query}")
+   results = (await rag_index.query_many_async([query], top_k=top_k))[0]
    print(f"RAG system returned {len(results)} results.")
    return results
 
+async def run_rag_many_async(queries, top_k=3):
+   """run_rag_many() for async callers."""
+   print(f"RAG system running for {len(queries)} queries")
+   results = await rag_index.query_many_async(list(queries), top_k=top_k)
+   print(f"RAG system returned {sum(len(r) for r in results)} results.")
+   return results
+
 # Example usage
 if __name__ == "__main__":
     import sys
@@ -6,9 +6,15 @@ import os, sys
 import subprocess, os, datetime, psutil
 from fastapi.middleware.cors import CORSMiddleware
 import json
+import asyncio
 import chat_model
 import side_agent
+import rag
 import time
+from board_watcher import board_watcher
+from board_cache import board_cache
+from http_client import http_client
+from snapshot_writer import snapshot_writer
 from patient_manager import patient_manager
 
 TARGET_SCRIPTS = ["visit_meet_with_audio.py", "gemini_audio_only_cable.py"]
@@ -21,10 +27,37 @@ app.add_middleware(
     allow_headers=["*"],        # <— Allow all headers
 )
 
+@app.on_event("startup")
+def load_rag_index():
+    """Load the process-resident RAG index once so queries skip the disk cache."""
+    rag.rag_index.load()
+    # Warm the pooled canvas client before the first request needs it
+    http_client.start()
+    # Keep the index synced in the background so queries never sync inline
+    board_watcher.start()
+
+@app.on_event("shutdown")
+def stop_board_watcher():
+    board_watcher.stop()
+    # Don't lose the last board snapshot on a clean shutdown
+    snapshot_writer.flush()
+    http_client.close()
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
+@app.get("/rag/stats")
+def rag_stats():
+    """Retrieval cache counters."""
+    return {
+        "query_cache": rag.query_cache.stats(),
+        "partitions": rag.rag_index.stats(),
+        "watcher": board_watcher.stats(),
+        "board": board_cache.stats(),
+        "snapshots": snapshot_writer.stats(),
+    }
+
 def kill_existing_processes(script_name: str):
     """Find and kill any running PowerShell or Python processes executing the target script."""
     for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
@@ -120,6 +153,9 @@ async def switch_patient(payload: dict):
     patient_id = payload.get("patientId")
     if patient_id:
         patient_manager.set_patient_id(patient_id)
+        # Open the patient's index partition now; revisits skip re-embedding
+        await asyncio.to_thread(rag.rag_index.get, patient_id)
+        board_watcher.wake()
         return {
             "status": "success",
             "patientId": patient_id,
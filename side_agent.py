@@ -1,6 +1,5 @@
 import os
 import google.generativeai as genai
-import requests
 import config
 from google.genai.types import GenerateContentConfig
 import json
@@ -12,9 +11,11 @@ import canvas_ops
 import asyncio
 import random
 import threading
-import httpx
 import rag
 from patient_manager import patient_manager
+from board_cache import board_cache
+from http_client import http_client
+from snapshot_writer import snapshot_writer
 
 
 
@@ -79,8 +80,8 @@ def parse_tool(query):
 async def resolve_object_id(query: str, context: str=""):
     if not context:
         # context = await rag_from_json(query, top_k=3)
-        context_raw = rag.run_rag(query)
-        context = json.dumps(context_raw, indent=4)
+        context_raw = await rag.run_rag_async(query)
+        context, _ = rag.build_context(context_raw)
     # Load system prompt
     with open("system_prompts/objectid_parser.md", "r", encoding="utf-8") as f:
         SYSTEM_PROMPT = f.read()
@@ -239,33 +240,26 @@ async def trigger_easl(question):
     return 
 
 
-async def load_ehr():
-    print("Start load_ehr")
-    patient_id = patient_manager.get_patient_id().lower()
-    url = BASE_URL + f"/api/board-items/{patient_id}"
-    
-    async with httpx.AsyncClient(timeout=10) as client:
-        response = await client.get(url)
-        data = response.json()
-        print("Status code:", response.status_code)
-        
-        # Handle new API format: {"patientId": "...", "items": [...]}
-        if isinstance(data, dict) and 'items' in data:
-            data = data['items']
-        
-        content_object = []
-        else_object = []
-        for d in data:
-            if d.get('id') == "dashboard-item-chronomed-2":
-                d['description'] = "This timeline functions similarly to a medication timeline, but with an expanded DILI assessment focus. It presents a chronological view of the patient’s clinical course, aligning multiple time-bound elements to support hepatotoxicity monitoring. Like the medication timeline tracks periods of drug exposure, this object also visualises medication start/stop dates, dose changes, and hepatotoxic risk levels. In addition, it integrates encounter history, longitudinal liver function test trends, and critical clinical events. Temporal relationships are highlighted to show how changes in medication correlate with laboratory abnormalities and clinical deterioration, providing causality links relevant to DILI analysis. The timeline is designed to facilitate retrospective assessment and ongoing monitoring by showing when key events occurred in relation to medication use and liver injury progression."
-                content_object.append(d)
+def ehr_content_view(data):
+    """Content objects (and the DILI timeline) of a board snapshot, for the clinical agent."""
+    content_object = []
+    else_object = []
+    for d in data:
+        if d.get('id') == "dashboard-item-chronomed-2":
+            d['description'] = "This timeline functions similarly to a medication timeline, but with an expanded DILI assessment focus. It presents a chronological view of the patient’s clinical course, aligning multiple time-bound elements to support hepatotoxicity monitoring. Like the medication timeline tracks periods of drug exposure, this object also visualises medication start/stop dates, dose changes, and hepatotoxic risk levels. In addition, it integrates encounter history, longitudinal liver function test trends, and critical clinical events. Temporal relationships are highlighted to show how changes in medication correlate with laboratory abnormalities and clinical deterioration, providing causality links relevant to DILI analysis. The timeline is designed to facilitate retrospective assessment and ongoing monitoring by showing when key events occurred in relation to medication use and liver injury progression."
+            content_object.append(d)
+
+        elif "content"in d.keys() or 'conversationHistory' in d.keys():
+            content_object.append(d)
 
-            elif "content"in d.keys() or 'conversationHistory' in d.keys():
-                content_object.append(d)
+        else:
+            else_object.append(d)
+    return content_object
 
-            else:
-                else_object.append(d)
-        return content_object
+async def load_ehr():
+    print("Start load_ehr")
+    # Shared board snapshot; the filtered view is built once per board version
+    return await board_cache.view_async("ehr_content", ehr_content_view)
 
 async def generate_response(todo_obj):
     with open("system_prompts/clinical_agent.md", "r", encoding="utf-8") as f:
@@ -436,8 +430,7 @@ async def generate_easl_diagnosis(ehr_data):
     result = json.loads(resp.text)
     # object_data = result.get("props",{})
     object_data = result
-    with open(f"{config.output_dir}/easl_diagnosis_object.json", "w", encoding="utf-8") as f:
-        json.dump(object_data, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/easl_diagnosis_object.json", object_data)
     return object_data
 
 
@@ -561,13 +554,11 @@ async def generate_task_obj(query):
     )
     ## Generated todo
     todo_json = json.loads(resp.text)
-    with open(f"{config.output_dir}/chatmode_todo_generated.json", "w", encoding="utf-8") as f:
-        json.dump(todo_json, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/chatmode_todo_generated.json", todo_json)
     ## Create todo object
     task_res = await canvas_ops.create_todo(todo_json)
 
-    with open(f"{config.output_dir}/chatmode_todo_object_response.json", "w", encoding="utf-8") as f:
-        json.dump(task_res, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/chatmode_todo_object_response.json", task_res)
 
     return todo_json, task_res
 
@@ -625,15 +616,13 @@ async def generate_todo(query:str):
     )
     ## Generated todo
     todo_json = json.loads(resp.text)
-    with open(f"{config.output_dir}/chatmode_todo_generated.json", "w", encoding="utf-8") as f:
-        json.dump(todo_json, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/chatmode_todo_generated.json", todo_json)
 
 
     ## Create todo object
     task_res = await canvas_ops.create_todo(todo_json)
 
-    with open(f"{config.output_dir}/chatmode_todo_object_response.json", "w", encoding="utf-8") as f:
-        json.dump(task_res, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/chatmode_todo_object_response.json", task_res)
     
     return task_res
 
@@ -690,15 +679,13 @@ async def generate_task_workflow(query: str):
     )
     ## Generated todo
     todo_json = json.loads(resp.text)
-    with open(f"{config.output_dir}/chatmode_todo_generated.json", "w", encoding="utf-8") as f:
-        json.dump(todo_json, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/chatmode_todo_generated.json", todo_json)
 
 
     ## Create todo object
     task_res = await canvas_ops.create_todo(todo_json)
 
-    with open(f"{config.output_dir}/chatmode_todo_object_response.json", "w", encoding="utf-8") as f:
-        json.dump(task_res, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/chatmode_todo_object_response.json", task_res)
 
     start_background_agent_processing(todo_json, task_res)
 
@@ -933,8 +920,7 @@ async def generate_dili_diagnosis():
     result.update(easl_res)
     # object_data = result.get("props",{})
     object_data = result
-    with open(f"{config.output_dir}/dili_diagnosis_object.json", "w", encoding="utf-8") as f:
-        json.dump(object_data, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/dili_diagnosis_object.json", object_data)
     return object_data
 
 
@@ -1224,20 +1210,18 @@ async def generate_patient_report():
         "patientData" : result
     }
 
-    with open(f"{config.output_dir}/patient_report_object.json", "w", encoding="utf-8") as f:
-        json.dump(object_data, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/patient_report_object.json", object_data)
     return object_data
 
 def create_diagnosis(payload):
     print("Start create object")
     url = BASE_URL + "/api/diagnostic-report"
     payload['zone'] = "dili-analysis-zone"
-    with open(f"{config.output_dir}/diagnosis_create_payload.json", "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=4)
-    response = requests.post(url, json=payload)
+    snapshot_writer.submit(f"{config.output_dir}/diagnosis_create_payload.json", payload)
+    response = http_client.post(url, json=payload)
+    board_cache.invalidate()
     print(response.status_code, "Create diagnosis")
-    with open(f"{config.output_dir}/diagnosis_create_response.json", "w", encoding="utf-8") as f:
-        json.dump(response.json(), f, ensure_ascii=False, indent=4)   
+    snapshot_writer.submit(f"{config.output_dir}/diagnosis_create_response.json", response.json())
 
 async def create_dili_diagnosis():
     print("Start generate DILI object")
@@ -1252,7 +1236,8 @@ def create_report(payload):
     print("Start create object")
     url = BASE_URL + "/api/patient-report"
     payload['zone'] = "patient-report-zone"
-    response = requests.post(url, json=payload)
+    response = http_client.post(url, json=payload)
+    board_cache.invalidate()
     print(response.status_code)
 
 async def create_patient_report():
@@ -1268,14 +1253,13 @@ def create_legal(payload):
     print("Start legal object")
     url = BASE_URL + "/api/legal-compliance"
 
-    with open(f"{config.output_dir}/legal_create_payload.json", "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=4)
-    response = requests.post(url, json=payload)
+    snapshot_writer.submit(f"{config.output_dir}/legal_create_payload.json", payload)
+    response = http_client.post(url, json=payload)
+    board_cache.invalidate()
     print(response.status_code)
     data = response.json()
 
-    with open(f"{config.output_dir}/legal_create_response.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    snapshot_writer.submit(f"{config.output_dir}/legal_create_response.json", data)
 
 
 async def create_legal_doc():
@@ -0,0 +1,136 @@
+"""
+Write-behind persistence for snapshot files (output/board_items.json and
+friends). These files only exist as offline fallbacks and debugging aids, so
+callers hand the data to a background worker instead of writing on the
+request path. Writes to the same path are debounced (at most one per
+interval, the latest data wins), encoded compactly and made atomic with a
+temp file plus rename, so a crash leaves either the old or the new file,
+never a torn one.
+"""
+
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+# Minimum seconds between two writes of the same file
+SNAPSHOT_WRITE_INTERVAL = float(os.getenv("SNAPSHOT_WRITE_INTERVAL", "2"))
+
+
+def encode_snapshot(data: Any) -> str:
+    """Compact JSON; lists get one item per line so the file stays diffable."""
+    if isinstance(data, list):
+        lines = ",\n".join(json.dumps(item, ensure_ascii=False, separators=(",", ":")) for item in data)
+        return f"[\n{lines}\n]\n" if data else "[]\n"
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def write_atomic(path: str, text: str) -> None:
+    """Write text to path via a temp file in the same directory and an atomic rename."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class SnapshotWriter:
+    """Background worker that coalesces snapshot writes per path."""
+
+    def __init__(self, interval: float = SNAPSHOT_WRITE_INTERVAL):
+        self.interval = interval
+        # path -> (sequence number, latest data not yet on disk)
+        self._pending: Dict[str, Tuple[int, Any]] = {}
+        self._last_write: Dict[str, float] = {}
+        # Sequence number of the newest data written per path; the worker and
+        # flush() pop batches independently, so an older batch can reach
+        # _write() after a newer one and must then be dropped
+        self._written: Dict[str, int] = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.metrics: Dict[str, Any] = {"submitted": 0, "coalesced": 0, "writes": 0, "errors": 0, "last_error": None}
+
+    def submit(self, path: str, data: Any) -> None:
+        """
+        Queue data to be written to path; returns immediately. The top-level
+        dict / list is copied, so callers may keep adding keys (e.g. a payload's
+        patientId), but nested values must not be mutated afterwards.
+        """
+        if isinstance(data, dict):
+            data = dict(data)
+        elif isinstance(data, list):
+            data = list(data)
+        with self._cond:
+            self.metrics["submitted"] += 1
+            if path in self._pending:
+                self.metrics["coalesced"] += 1
+            self._seq += 1
+            self._pending[path] = (self._seq, data)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    waits = {path: self._last_write.get(path, 0.0) + self.interval - now for path in self._pending}
+                    due = [path for path, wait in waits.items() if wait <= 0]
+                    if due:
+                        break
+                    self._cond.wait(min(waits.values()) if waits else None)
+                batch = {path: self._pending.pop(path) for path in due}
+                for path in due:
+                    self._last_write[path] = now
+            self._write(batch)
+
+    def _write(self, batch: Dict[str, Tuple[int, Any]]) -> None:
+        # Serialized with flush() so two writers never race on one path
+        with self._write_lock:
+            for path, (seq, data) in batch.items():
+                if seq <= self._written.get(path, 0):
+                    self.metrics["coalesced"] += 1
+                    continue
+                self._written[path] = seq
+                try:
+                    write_atomic(path, encode_snapshot(data))
+                    self.metrics["writes"] += 1
+                except Exception as e:
+                    self.metrics["errors"] += 1
+                    self.metrics["last_error"] = str(e)
+                    print(f"⚠️ Snapshot write failed for {path}: {e}")
+
+    def flush(self) -> None:
+        """Write everything still pending now (shutdown, tests)."""
+        with self._cond:
+            batch = dict(self._pending)
+            self._pending.clear()
+            now = time.time()
+            for path in batch:
+                self._last_write[path] = now
+        self._write(batch)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self.metrics)
+        stats["pending"] = len(self._pending)
+        return stats
+
+
+# Process-wide writer; whatever is still pending is written on interpreter exit
+snapshot_writer = SnapshotWriter()
+atexit.register(snapshot_writer.flush)
@@ -0,0 +1,71 @@
+"""
+Offline tests for the RAG index (rag.py): embeddings are faked and every
+index / store file lives in a temporary directory, so no server or Vertex
+credentials are needed. Run with: python -m pytest -q test_rag_index.py
+"""
+
+import os
+
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "test")
+os.environ.setdefault("PROJECT_ID", "test")
+
+import numpy as np
+import pytest
+
+import rag
+from embedding_store import EmbeddingStore
+
+BOARD = [
+    {"id": "lab-1", "type": "lab", "title": "Liver panel", "content": "ALT 120 U/L, AST 98 U/L"},
+    {"id": "med-1", "type": "medication", "title": "Medications", "content": "Methotrexate 15 mg weekly"},
+    {"id": "enc-1", "type": "encounter", "title": "Visit", "content": "Fatigue and mild jaundice"},
+]
+
+
+@pytest.fixture
+def embedded(monkeypatch, tmp_path):
+    """Fake embedding API; returns the list of texts sent to it."""
+    sent = []
+
+    def fake_batch(texts, output_dim=rag.EMBEDDING_DIM):
+        sent.extend(texts)
+        rng = np.random.default_rng(len(sent))
+        return rng.standard_normal((len(texts), output_dim)).tolist()
+
+    store = EmbeddingStore(str(tmp_path / "embedding_store.sqlite"))
+    monkeypatch.setattr(rag, "get_embeddings_batch", fake_batch)
+    monkeypatch.setattr(rag, "embedding_store", store)
+    monkeypatch.setattr(rag, "_migrate_legacy_once", lambda: None)
+    monkeypatch.setattr(rag, "rag_index", rag.PartitionedRagIndex(root=str(tmp_path / "index")))
+    monkeypatch.setattr(rag, "load_board_items", lambda path, patient_id=None: [dict(item) for item in BOARD])
+    return sent
+
+
+def test_rebuild_reembeds_every_item(embedded):
+    first = rag.initialize_rag()
+    first_version = first.version
+    assert len(first) == len(BOARD)
+
+    embedded.clear()
+    assert rag.initialize_rag().version == first_version
+    assert embedded == []
+
+    index = rag.initialize_rag(force_rebuild=True)
+    assert index.version > first_version
+    assert len(index) == len(BOARD)
+    # Every chunk went to the embedding API again, none came from the store
+    expected = [chunk for item in BOARD for chunk in rag.extract_chunks(item)[1]]
+    assert sorted(embedded) == sorted(expected)
+
+
+def test_duplicate_ids_that_fail_to_embed(embedded, monkeypatch, tmp_path):
+    monkeypatch.setattr(rag, "get_embeddings_batch", lambda texts, output_dim=rag.EMBEDDING_DIM: [None] * len(texts))
+    duplicated = [dict(BOARD[0]), dict(BOARD[0], content="ALT 140 U/L"), dict(BOARD[1])]
+
+    rows, stats = rag.build_index(duplicated)
+    assert rows == {}
+    assert stats["new"] == 3
+
+    index = rag.RagIndex("p-dup", str(tmp_path / "dup"))
+    index.sync(board_items=duplicated)
+    assert len(index) == 0